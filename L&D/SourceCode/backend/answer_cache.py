@@ -0,0 +1,98 @@
+"""answer_cache.py
+
+Semantic response cache for ask_rag.
+
+A cached ApiResponse is reused when a new request has the same case context, retrieved exactly the
+same manual chunks (same collection, point ids and chunk text), and its standalone question embedding is
+within a cosine threshold of the cached one. Entries live in a namespace derived from the Qdrant
+collection; when the namespace changes every entry from the previous one is dropped.
+"""
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+from models import ApiResponse
+
+
+def section_fingerprint(search_result) -> tuple:
+    """Order-independent key for a retrieved set: collection and point id plus a hash of the chunk text."""
+    return tuple(sorted(
+        (
+            str((r.payload or {}).get("collection", "")),
+            str(r.id),
+            hashlib.sha1((r.payload or {}).get("content", "").encode("utf-8")).hexdigest(),
+        )
+        for r in search_result
+    ))
+
+
+def _unit(vector: List[float]) -> List[float]:
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+class SemanticAnswerCache:
+    """Bounded, TTL-limited map of (namespace, case context, section set) -> recent answers."""
+
+    # Distinct question phrasings kept for one retrieved section set.
+    _ENTRIES_PER_BUCKET = 8
+
+    def __init__(self, similarity_threshold: float = 0.95, max_buckets: int = 1024, ttl_seconds: float = 24 * 3600):
+        self.similarity_threshold = similarity_threshold
+        self.max_buckets = max_buckets
+        self.ttl_seconds = ttl_seconds
+        self.namespace = None
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def use_namespace(self, namespace: str) -> None:
+        """Switches to `namespace`, dropping everything cached under a different one."""
+        with self._lock:
+            if namespace != self.namespace:
+                if self.namespace is not None:
+                    print(f"LOG: Answer cache namespace changed ({self.namespace} -> {namespace}); clearing.")
+                self._buckets.clear()
+                self.namespace = namespace
+
+    def clear(self) -> None:
+        with self._lock:
+            self._buckets.clear()
+
+    def lookup(self, case_context: str, sections: tuple, embedding: List[float]) -> Optional[ApiResponse]:
+        if not sections:
+            return None
+        key = self._key(case_context, sections)
+        query = _unit(embedding)
+        now = time.time()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if not bucket:
+                return None
+            bucket[:] = [e for e in bucket if now - e[2] < self.ttl_seconds]
+            best, best_score = None, self.similarity_threshold
+            for vector, response, _created_at in bucket:
+                score = sum(a * b for a, b in zip(query, vector))
+                if score >= best_score:
+                    best, best_score = response, score
+            if best is None:
+                return None
+            self._buckets.move_to_end(key)
+            return best.model_copy(deep=True)
+
+    def store(self, case_context: str, sections: tuple, embedding: List[float], response: ApiResponse) -> None:
+        if not sections:
+            return
+        key = self._key(case_context, sections)
+        with self._lock:
+            bucket = self._buckets.setdefault(key, [])
+            bucket.append((_unit(embedding), response.model_copy(deep=True), time.time()))
+            del bucket[:-self._ENTRIES_PER_BUCKET]
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+
+    def _key(self, case_context: str, sections: tuple) -> tuple:
+        return hashlib.sha1(case_context.encode("utf-8")).hexdigest(), sections
@@ -1,13 +1,23 @@
-from fastapi import FastAPI
+import json
+import time
+from typing import List
+
+import openai
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+from manual_registry import UnknownManualError
+from metrics import REQUEST_SECONDS, render_latest, server_timing_header, start_request
 
 from models import (
     ApiResponse,
+    BatchItemResult,
     SuggestQuestionsRequest,
     SuggestQuestionsResponse,
     UserQuery,
 )
-from rag_utils import ask_rag, suggest_questions
+from rag_utils import ask_rag, ask_rag_batch, ask_rag_stream, suggest_questions
 
 allowed_origins = [
     "http://localhost",  
@@ -20,13 +30,79 @@ app = FastAPI(
     description="API that answers questions with validated police manual sources."
 )
 
+@app.middleware("http")
+async def server_timing(request: Request, call_next):
+    """ Collects per-stage timings for the request and returns them in a Server-Timing header. """
+    timings = start_request()
+    started = time.perf_counter()
+    response = await call_next(request)
+    elapsed = time.perf_counter() - started
+    route = request.scope.get("route")
+    REQUEST_SECONDS.labels(getattr(route, "path", "unmatched")).observe(elapsed)
+    # Streaming responses send their headers before the pipeline runs, so they only carry "total".
+    timings["total"] = elapsed
+    response.headers["Server-Timing"] = server_timing_header(timings)
+    return response
+
+@app.exception_handler(UnknownManualError)
+async def unknown_manual_handler(request: Request, exc: UnknownManualError):
+    return JSONResponse(status_code=400, content={"detail": str(exc)})
+
+@app.exception_handler(openai.RateLimitError)
+async def rate_limit_handler(request: Request, exc: openai.RateLimitError):
+    """ Azure quota still exhausted after retries: pass the throttle on instead of failing with a 500. """
+    retry_after = exc.response.headers.get("retry-after") if exc.response is not None else None
+    headers = {"Retry-After": retry_after} if retry_after else None
+    return JSONResponse(status_code=429, content={"detail": "The language model is busy. Please retry shortly."}, headers=headers)
+
+@app.exception_handler(openai.APITimeoutError)
+async def llm_timeout_handler(request: Request, exc: openai.APITimeoutError):
+    return JSONResponse(status_code=504, content={"detail": "The language model did not respond in time."})
+
 @app.post("/manual/answers", response_model=ApiResponse)
-def ask_question(query: UserQuery):
-    return ask_rag(query)
+async def ask_question(query: UserQuery):
+    return await ask_rag(query)
+
+@app.post("/manual/answers/stream")
+async def ask_question_stream(query: UserQuery):
+    """ Streams the answer as Server-Sent Events: question, sources, token..., validated_sources. """
+    # Validating the manuals and resolving the question happen before the first event, so request
+    # errors get the same status codes as /manual/answers; only later failures become "error" events.
+    events = ask_rag_stream(query)
+    first_event = await events.__anext__()
+
+    async def event_stream():
+        try:
+            yield _format_sse(*first_event)
+            async for event, data in events:
+                yield _format_sse(event, data)
+        except Exception as e:
+            print(f"Error while streaming answer: {e}")
+            yield _format_sse("error", {"detail": str(e)})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+def _format_sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/manual/answers:batch", response_model=List[BatchItemResult])
+async def ask_questions_batch(queries: List[UserQuery]):
+    """ Answers a list of questions in input order; also useful for warming the caches. """
+    return await ask_rag_batch(queries)
 
 @app.post("/manual/suggest-questions", response_model=SuggestQuestionsResponse)
-def suggest_questions_endpoint(request: SuggestQuestionsRequest):
-    return suggest_questions(request)
+async def suggest_questions_endpoint(request: SuggestQuestionsRequest):
+    return await suggest_questions(request)
+
+@app.get("/metrics", include_in_schema=False)
+def metrics_endpoint():
+    """ Prometheus metrics: per-stage latency, LLM tokens and cache hit/miss counts. """
+    body, content_type = render_latest()
+    return Response(content=body, media_type=content_type)
 
 @app.get("/", include_in_schema=False)
 def read_root():
@@ -0,0 +1,146 @@
+"""azure_transport.py
+
+HTTP transport and retry policy for the Azure OpenAI client in rag_utils.
+
+One keep-alive httpx pool is shared by every call a worker makes, sized to the worker's request
+concurrency so a burst reuses warm TLS connections instead of opening new ones. Each request is
+traced through httpcore to count new vs reused connections and to time the handshakes.
+
+The OpenAI client's own retries are turned off; `call_with_retry` retries 429s, 5xx responses,
+timeouts and dropped connections with jittered exponential backoff, waiting at least as long as a
+Retry-After (or retry-after-ms) header asks, and records every retry by stage.
+"""
+import asyncio
+import email.utils
+import random
+import time
+from typing import Awaitable, Callable, Optional
+
+import httpx
+import openai
+from prometheus_client import Counter, Histogram
+
+HTTP_CONNECTIONS = Counter(
+    "ld_azure_http_requests_total",
+    "Azure OpenAI HTTP requests by whether they opened a new connection or reused a pooled one.",
+    ["connection"],
+)
+HTTP_CONNECT_SECONDS = Histogram(
+    "ld_azure_http_connect_seconds",
+    "TCP connect plus TLS handshake time for new Azure OpenAI connections.",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+LLM_RETRIES = Counter(
+    "ld_azure_retries_total",
+    "Azure OpenAI calls retried, by stage and reason.",
+    ["stage", "reason"],
+)
+
+_RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+
+class _ConnectionTrace:
+    """httpcore trace extension for one request: notes whether it had to open a connection."""
+
+    def __init__(self):
+        self.new_connection = False
+        self._connect_started = None
+
+    async def __call__(self, event_name: str, info: dict):
+        if event_name == "connection.connect_tcp.started":
+            self.new_connection = True
+            self._connect_started = time.perf_counter()
+        elif event_name.endswith(".send_request_headers.started") and self._connect_started is not None:
+            # First bytes on a new connection: TCP connect and any TLS handshake are done.
+            HTTP_CONNECT_SECONDS.observe(time.perf_counter() - self._connect_started)
+            self._connect_started = None
+
+
+async def _on_request(request: httpx.Request):
+    request.extensions["trace"] = _ConnectionTrace()
+
+
+async def _on_response(response: httpx.Response):
+    trace = response.request.extensions.get("trace")
+    HTTP_CONNECTIONS.labels("new" if getattr(trace, "new_connection", False) else "reused").inc()
+
+
+def create_http_client(max_connections: int, keepalive_expiry: float = 60.0, connect_timeout: float = 5.0,
+                       default_timeout: float = 60.0) -> httpx.AsyncClient:
+    """Shared keep-alive pool for the Azure OpenAI client."""
+    return openai.DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=keepalive_expiry,
+        ),
+        timeout=httpx.Timeout(default_timeout, connect=connect_timeout),
+        event_hooks={"request": [_on_request], "response": [_on_response]},
+    )
+
+
+def retry_after_seconds(error) -> Optional[float]:
+    """Delay requested by the server through retry-after-ms or Retry-After (seconds or HTTP date)."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            retry_at = email.utils.parsedate_to_datetime(value)
+            return max(retry_at.timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, base_delay: float, max_delay: float, retry_after: Optional[float] = None) -> float:
+    """Full-jitter exponential backoff, never shorter than the server's Retry-After."""
+    delay = random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+    if retry_after is not None:
+        # A little jitter on top keeps callers throttled together from retrying in lockstep.
+        delay = max(delay, retry_after + random.uniform(0, base_delay))
+    return delay
+
+
+def _retry_reason(error) -> str:
+    if isinstance(error, openai.RateLimitError):
+        return "rate_limited"
+    if isinstance(error, openai.APITimeoutError):
+        return "timeout"
+    if isinstance(error, openai.APIConnectionError):
+        return "connection"
+    return "server_error"
+
+
+async def call_with_retry(stage_name: str, make_call: Callable[[], Awaitable], max_attempts: int = 4,
+                          base_delay: float = 0.5, max_delay: float = 20.0):
+    """Awaits `make_call()`, retrying transient Azure failures up to `max_attempts` calls in total."""
+    attempt = 1
+    while True:
+        try:
+            return await make_call()
+        except _RETRYABLE_ERRORS as e:
+            if attempt >= max_attempts:
+                raise
+            reason = _retry_reason(e)
+            retry_after = retry_after_seconds(e)
+            if retry_after is not None and retry_after > max_delay:
+                # Waiting out a long throttle would hold the request open; let the caller see the 429.
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay, retry_after)
+            LLM_RETRIES.labels(stage_name, reason).inc()
+            print(f"WARN: {stage_name} call failed ({reason}), retry {attempt}/{max_attempts - 1} in {delay:.2f}s: {e}")
+            await asyncio.sleep(delay)
+            attempt += 1
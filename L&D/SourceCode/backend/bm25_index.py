@@ -0,0 +1,139 @@
+"""bm25_index.py
+
+BM25 inverted index over manual chunks, used alongside dense search for exact Connect terms such as
+"PNC", "MG11" or section numbers like "9.4" that embeddings tend to blur.
+
+The index is built at ingest time (ingest_to_qdrant.py calls build_bm25_index) and saved as one
+compressed .npz file holding the vocabulary, CSR-style postings (doc rows and term frequencies),
+document lengths and the Qdrant point ids of the indexed chunks.
+"""
+import json
+import math
+import os
+import re
+from typing import Iterable, List, Tuple
+
+import numpy as np
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:\.[0-9]+)*")
+_STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from", "how", "i",
+    "in", "is", "it", "me", "my", "of", "on", "or", "the", "to", "what", "when", "where", "which",
+    "who", "why", "with", "you", "your",
+}
+
+
+def tokenize(text: str) -> List[str]:
+    """Lower-cased word tokens; dotted numbers such as 9.4 or 12.1.3 are kept whole."""
+    return [t for t in _TOKEN_PATTERN.findall((text or "").lower()) if t not in _STOPWORDS]
+
+
+def chunk_text(payload: dict) -> str:
+    """Fields indexed for a chunk. The title is repeated so a title match outweighs a passing mention."""
+    title = payload.get("section_title") or ""
+    return " ".join([payload.get("section_number") or "", title, title, payload.get("content") or ""])
+
+
+def default_index_path(collection_name: str) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "bm25", f"{collection_name}.npz")
+
+
+class BM25Index:
+    def __init__(self, ids: list, vocabulary: List[str], term_offsets: np.ndarray, posting_rows: np.ndarray,
+                 posting_tfs: np.ndarray, doc_lengths: np.ndarray):
+        self.ids = ids
+        self.term_index = {term: i for i, term in enumerate(vocabulary)}
+        self.term_offsets = term_offsets
+        self.posting_rows = posting_rows
+        self.posting_tfs = posting_tfs.astype(np.float32)
+        self.doc_lengths = doc_lengths.astype(np.float32)
+        self.avg_doc_length = float(self.doc_lengths.mean()) if len(self.doc_lengths) else 0.0
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        with np.load(path, allow_pickle=False) as data:
+            return cls(
+                ids=json.loads(str(data["ids"])),
+                vocabulary=data["vocabulary"].tolist(),
+                term_offsets=data["term_offsets"],
+                posting_rows=data["posting_rows"],
+                posting_tfs=data["posting_tfs"],
+                doc_lengths=data["doc_lengths"],
+            )
+
+    def search(self, query: str, top_k: int) -> List[Tuple[object, float]]:
+        """Returns (point id, BM25 score) pairs, best first; only documents matching a term."""
+        n_docs = len(self.ids)
+        if not n_docs or top_k <= 0:
+            return []
+        scores = np.zeros(n_docs, dtype=np.float32)
+        length_norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths / (self.avg_doc_length or 1.0))
+        for term in set(tokenize(query)):
+            term_id = self.term_index.get(term)
+            if term_id is None:
+                continue
+            start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+            rows = self.posting_rows[start:end]
+            tfs = self.posting_tfs[start:end]
+            idf = math.log(1 + (n_docs - len(rows) + 0.5) / (len(rows) + 0.5))
+            scores[rows] += idf * tfs * (BM25_K1 + 1) / (tfs + length_norm[rows])
+
+        matched = np.flatnonzero(scores)
+        if not len(matched):
+            return []
+        best = matched[np.argsort(-scores[matched])][:top_k]
+        return [(self.ids[row], float(scores[row])) for row in best]
+
+
+def build_bm25_index(points: Iterable[Tuple[object, dict]], path: str) -> BM25Index:
+    """Builds the index from (point id, payload) pairs and writes it to `path`."""
+    ids, doc_terms = [], []
+    for point_id, payload in points:
+        ids.append(point_id)
+        counts = {}
+        for token in tokenize(chunk_text(payload)):
+            counts[token] = counts.get(token, 0) + 1
+        doc_terms.append(counts)
+
+    postings = {}
+    for row, counts in enumerate(doc_terms):
+        for term, tf in counts.items():
+            postings.setdefault(term, []).append((row, tf))
+
+    vocabulary = sorted(postings)
+    term_offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+    rows, tfs = [], []
+    for i, term in enumerate(vocabulary):
+        for row, tf in postings[term]:
+            rows.append(row)
+            tfs.append(min(tf, np.iinfo(np.uint16).max))
+        term_offsets[i + 1] = len(rows)
+
+    arrays = {
+        "term_offsets": term_offsets,
+        "posting_rows": np.asarray(rows, dtype=np.int32),
+        "posting_tfs": np.asarray(tfs, dtype=np.uint16),
+        "doc_lengths": np.asarray([sum(c.values()) for c in doc_terms], dtype=np.int32),
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # Write via a file handle so numpy does not append a second ".npz" suffix to the temporary name.
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez_compressed(
+            f, ids=np.asarray(json.dumps(ids)), vocabulary=np.asarray(vocabulary, dtype=np.str_), **arrays
+        )
+    os.replace(tmp_path, path)
+    print(f"Wrote BM25 index with {len(ids)} chunks and {len(vocabulary)} terms to '{path}'.")
+    return BM25Index(ids=ids, vocabulary=vocabulary, **arrays)
+
+
+def reciprocal_rank_fusion(rankings: List[List[object]], k: int = 60) -> List[Tuple[object, float]]:
+    """Fuses ranked id lists; each list contributes 1 / (k + rank) for every id it contains."""
+    fused = {}
+    for ranking in rankings:
+        for rank, point_id in enumerate(ranking, start=1):
+            fused[point_id] = fused.get(point_id, 0.0) + 1.0 / (k + rank)
+    return sorted(fused.items(), key=lambda item: -item[1])
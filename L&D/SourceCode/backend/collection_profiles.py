@@ -0,0 +1,165 @@
+"""collection_profiles.py
+
+Qdrant collection profiles shared by ingest (how a collection is created) and the backend (how it is
+searched).
+
+A profile fixes the HNSW graph parameters, scalar int8 quantization, where vectors and payloads
+live (RAM or disk), and the payload indexes created on the chunk fields we filter on. The int8 copy
+of the vectors is kept in RAM and searched first; the top hits are then rescored against the
+original float32 vectors, so recall stays close to exact search while the hot index is a quarter
+of the size.
+
+    balanced    int8 quantization in RAM, float32 vectors in RAM, payload on disk (default)
+    low_memory  int8 quantization in RAM, float32 vectors and payload on disk
+    exact       no quantization, everything in RAM; useful for comparing recall
+
+On the query side only SEARCH_PAYLOAD_FIELDS are fetched with each hit, so searches no longer
+ship the whole chunk dict, and `search_params` carries the search-time hnsw_ef and oversampling.
+
+Apply a profile to an existing collection without re-ingesting:
+    python collection_profiles.py --apply --collection <name> [--profile balanced]
+"""
+import argparse
+import os
+from typing import List, Optional
+
+from qdrant_client import models
+
+COLLECTION_PROFILES = {
+    "balanced": {
+        "hnsw_m": 16,
+        "hnsw_ef_construct": 200,
+        "quantization": True,
+        "vectors_on_disk": False,
+        "on_disk_payload": True,
+    },
+    "low_memory": {
+        "hnsw_m": 16,
+        "hnsw_ef_construct": 200,
+        "quantization": True,
+        "vectors_on_disk": True,
+        "on_disk_payload": True,
+    },
+    "exact": {
+        "hnsw_m": 16,
+        "hnsw_ef_construct": 100,
+        "quantization": False,
+        "vectors_on_disk": False,
+        "on_disk_payload": False,
+    },
+}
+
+# Keyword indexes on the chunk fields used in filters (`type` separates sections from image captions).
+PAYLOAD_INDEXES = {
+    "section_number": models.PayloadSchemaType.KEYWORD,
+    "type": models.PayloadSchemaType.KEYWORD,
+}
+
+# Payload fields the backend reads from a search hit; everything else stays on the server.
+SEARCH_PAYLOAD_FIELDS = [
+    "content",
+    "section_number",
+    "section_title",
+    "page_number",
+    "type",
+    "parent_section_number",
+    "occurrences",
+]
+
+# Quantile used to clip outliers when choosing the int8 range.
+_QUANTIZATION_QUANTILE = 0.99
+
+
+def get_profile(name: str) -> dict:
+    if name not in COLLECTION_PROFILES:
+        raise ValueError(f"Unknown collection profile '{name}'. Expected one of: {', '.join(COLLECTION_PROFILES)}.")
+    return COLLECTION_PROFILES[name]
+
+
+def collection_config(profile_name: str, vector_size: int) -> dict:
+    """Keyword arguments for QdrantClient.create_collection / recreate_collection."""
+    profile = get_profile(profile_name)
+    return {
+        "vectors_config": models.VectorParams(
+            size=vector_size,
+            distance=models.Distance.COSINE,
+            on_disk=profile["vectors_on_disk"],
+        ),
+        "hnsw_config": models.HnswConfigDiff(m=profile["hnsw_m"], ef_construct=profile["hnsw_ef_construct"]),
+        "quantization_config": _quantization_config(profile),
+        "on_disk_payload": profile["on_disk_payload"],
+    }
+
+
+def create_payload_indexes(client, collection_name: str):
+    for field_name, schema in PAYLOAD_INDEXES.items():
+        client.create_payload_index(collection_name=collection_name, field_name=field_name, field_schema=schema, wait=True)
+    print(f"Created payload indexes on {', '.join(PAYLOAD_INDEXES)} for '{collection_name}'.")
+
+
+def apply_profile(client, collection_name: str, profile_name: str):
+    """Moves an existing collection to a profile; Qdrant rebuilds the index and quantization in the background."""
+    profile = get_profile(profile_name)
+    client.update_collection(
+        collection_name=collection_name,
+        vectors_config={"": models.VectorParamsDiff(on_disk=profile["vectors_on_disk"])},
+        hnsw_config=models.HnswConfigDiff(m=profile["hnsw_m"], ef_construct=profile["hnsw_ef_construct"]),
+        quantization_config=_quantization_config(profile) or models.Disabled.DISABLED,
+        collection_params=models.CollectionParamsDiff(on_disk_payload=profile["on_disk_payload"]),
+    )
+    create_payload_indexes(client, collection_name)
+    print(f"Applied collection profile '{profile_name}' to '{collection_name}'.")
+
+
+def search_params(hnsw_ef: Optional[int] = None, oversampling: Optional[float] = None,
+                  rescore: bool = True) -> models.SearchParams:
+    """Search-time parameters. Quantization settings are ignored by collections without quantization."""
+    return models.SearchParams(
+        hnsw_ef=hnsw_ef,
+        quantization=models.QuantizationSearchParams(rescore=rescore, oversampling=oversampling),
+    )
+
+
+def type_filter(chunk_types: Optional[List[str]] = None,
+                exclude_chunk_types: Optional[List[str]] = None) -> Optional[models.Filter]:
+    """Filter on the indexed `type` payload field; None when neither list is given."""
+    if not chunk_types and not exclude_chunk_types:
+        return None
+    return models.Filter(
+        must=[models.FieldCondition(key="type", match=models.MatchAny(any=list(chunk_types)))] if chunk_types else None,
+        must_not=[
+            models.FieldCondition(key="type", match=models.MatchAny(any=list(exclude_chunk_types)))
+        ] if exclude_chunk_types else None,
+    )
+
+
+def payload_selector(fields: Optional[List[str]] = None):
+    """Payload projection for search calls; an empty field list fetches the whole payload."""
+    if not fields:
+        return True
+    return models.PayloadSelectorInclude(include=list(fields))
+
+
+def _quantization_config(profile: dict):
+    if not profile["quantization"]:
+        return None
+    return models.ScalarQuantization(
+        scalar=models.ScalarQuantizationConfig(
+            type=models.ScalarType.INT8,
+            quantile=_QUANTIZATION_QUANTILE,
+            always_ram=True,
+        )
+    )
+
+
+if __name__ == "__main__":
+    from qdrant_client import QdrantClient
+
+    parser = argparse.ArgumentParser(description="Apply a collection profile to an existing Qdrant collection.")
+    parser.add_argument("--apply", action="store_true", required=True)
+    parser.add_argument("--collection", required=True)
+    parser.add_argument("--profile", default=os.getenv("COLLECTION_PROFILE", "balanced"), choices=list(COLLECTION_PROFILES))
+    parser.add_argument("--qdrant-url", default="http://localhost:6333")
+    args = parser.parse_args()
+
+    apply_profile(QdrantClient(args.qdrant_url), args.collection, args.profile)
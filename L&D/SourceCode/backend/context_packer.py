@@ -0,0 +1,129 @@
+"""context_packer.py
+
+Builds the "CONTEXT FROM MANUAL" block under a token budget.
+
+Hits are taken in the order the retriever returned them, which is its ranking (fused rank for
+hybrid search, section and image slots for typed retrieval); hit.score is the cosine similarity
+and does not reflect that order. Image-caption chunks are dropped when their parent section was also
+retrieved (the section text already carries the "--- Image: ... ---" marker). Sections longer than
+the per-chunk cap are cut down to a window of paragraphs around the passage that best matches the
+question. Packing stops once the budget is spent; the last chunk is windowed to fit when there is
+enough room left for it to be useful.
+"""
+import re
+from typing import List, Tuple
+
+from bm25_index import tokenize
+
+try:
+    import tiktoken
+
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:  # tiktoken is optional; fall back to an estimate
+    _encoding = None
+
+# Roughly four characters per token for English text, used when tiktoken is unavailable.
+_CHARS_PER_TOKEN = 4
+# Below this many spare tokens a trailing chunk is not worth including.
+_MIN_USEFUL_TOKENS = 80
+_ELISION = "[...]"
+
+
+def count_tokens(text: str) -> int:
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return (len(text) + _CHARS_PER_TOKEN - 1) // _CHARS_PER_TOKEN
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    if _encoding is not None:
+        tokens = _encoding.encode(text, disallowed_special=())
+        return text if len(tokens) <= max_tokens else _encoding.decode(tokens[:max_tokens])
+    return text[:max_tokens * _CHARS_PER_TOKEN]
+
+
+def truncate_to_last_tokens(text: str, max_tokens: int) -> str:
+    """Keeps the end of `text`, marking the cut with an elision, so the newest lines survive."""
+    if count_tokens(text) <= max_tokens:
+        return text
+    keep = max(max_tokens - count_tokens(_ELISION + "\n"), 0)
+    if _encoding is not None:
+        tokens = _encoding.encode(text, disallowed_special=())
+        tail = _encoding.decode(tokens[len(tokens) - keep:]) if keep else ""
+    else:
+        tail = text[len(text) - keep * _CHARS_PER_TOKEN:] if keep else ""
+    return f"{_ELISION}\n{tail}"
+
+
+def pack_context(search_result, question: str, token_budget: int, max_chunk_tokens: int) -> List[Tuple[object, str]]:
+    """Returns (hit, text to include) pairs, in retrieval order, that fit within `token_budget`."""
+    hits = list(search_result)
+    retrieved_sections = {
+        _section_key(hit.payload or {}) for hit in hits if (hit.payload or {}).get("type") == "section"
+    }
+    question_terms = set(tokenize(question))
+
+    packed, used = [], 0
+    for hit in hits:
+        payload = hit.payload or {}
+        if payload.get("type") == "image" and _section_key(payload) in retrieved_sections:
+            continue
+        content = payload.get("content", "")
+        if not content:
+            continue
+        for figure in payload.get("images", []):
+            # Captions of images attached to this section by TypedRetriever.
+            content += f"\n\n[Figure, page {figure.get('page_number', 'N/A')}] {figure.get('content', '')}"
+
+        if token_budget - used < _MIN_USEFUL_TOKENS and packed:
+            break
+        allowance = min(max_chunk_tokens, token_budget - used)
+        text = content if count_tokens(content) <= allowance else window_passage(content, question_terms, allowance)
+        packed.append((hit, text))
+        used += count_tokens(text)
+    return packed
+
+
+def window_passage(content: str, question_terms: set, max_tokens: int) -> str:
+    """Keeps the best-matching paragraph and grows outwards to its neighbours while they fit."""
+    paragraphs = [p for p in re.split(r"\n\s*\n", content) if p.strip()]
+    return _window(paragraphs, "\n\n", question_terms, max_tokens)
+
+
+def _window(units: List[str], joiner: str, question_terms: set, max_tokens: int) -> str:
+    if not units:
+        return ""
+    overlap = [len(question_terms & set(tokenize(u))) for u in units]
+    best = max(range(len(units)), key=lambda i: (overlap[i], -i))
+    sizes = [count_tokens(u) for u in units]
+
+    if sizes[best] > max_tokens:
+        # An oversize paragraph is windowed again line by line; a single long line is cut.
+        lines = [line for line in units[best].split("\n") if line.strip()]
+        if len(lines) > 1:
+            text = _window(lines, "\n", question_terms, max_tokens)
+        else:
+            text = truncate_to_tokens(units[best], max_tokens)
+        low, high = best, best
+    else:
+        low, high, used = best, best, sizes[best]
+        while True:
+            grown = False
+            for candidate in (high + 1, low - 1):
+                if 0 <= candidate < len(units) and not low <= candidate <= high and used + sizes[candidate] <= max_tokens:
+                    low, high = min(low, candidate), max(high, candidate)
+                    used += sizes[candidate]
+                    grown = True
+            if not grown:
+                break
+        text = joiner.join(units[low:high + 1])
+
+    if low > 0 and not text.startswith(_ELISION):
+        text = f"{_ELISION}\n{text}"
+    if high < len(units) - 1 and not text.endswith(_ELISION):
+        text = f"{text}\n{_ELISION}"
+    return text
+
+
+def _section_key(payload: dict) -> tuple:
+    return payload.get("collection"), payload.get("section_number")
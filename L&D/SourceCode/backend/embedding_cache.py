@@ -0,0 +1,141 @@
+"""embedding_cache.py
+
+Two-tier cache for question embeddings.
+
+The first tier is an in-process LRU. The second tier is a SQLite file on local disk: it survives
+restarts and is shared by every uvicorn worker on the host (WAL mode allows concurrent readers).
+Disk reads and writes run in a worker thread with a short busy timeout, so an ingest or another
+worker holding the write lock never stalls the event loop; contention is treated as a miss.
+Entries are keyed by embedding deployment name and normalised question text, so switching the
+embedding model never serves a vector from the old one.
+"""
+import asyncio
+import os
+import re
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import List, Optional
+
+
+def normalise_question(text: str) -> str:
+    """Lower-cases and collapses whitespace so trivially different spellings share an entry."""
+    return re.sub(r"\s+", " ", text or "").strip().lower()
+
+
+class EmbeddingCache:
+    """In-process LRU backed by an optional on-disk SQLite store, with size bounds and TTL."""
+
+    # Trim the disk store once every this many writes rather than on every insert.
+    _PRUNE_EVERY = 256
+    # How long a disk read or write waits for another writer before giving up.
+    _BUSY_TIMEOUT = 0.2
+
+    def __init__(self, path: Optional[str], max_memory_entries: int = 2048,
+                 max_disk_entries: int = 100_000, ttl_seconds: float = 7 * 24 * 3600):
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl_seconds = ttl_seconds
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._writes_since_prune = 0
+        self._db = self._open(path) if path else None
+
+    def _open(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        db = sqlite3.connect(path, timeout=self._BUSY_TIMEOUT, check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " deployment TEXT NOT NULL,"
+            " question TEXT NOT NULL,"
+            " vector BLOB NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " PRIMARY KEY (deployment, question))"
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS embeddings_created_at ON embeddings (created_at)")
+        return db
+
+    async def get(self, deployment: str, question: str) -> Optional[List[float]]:
+        return (await self.get_many(deployment, [question]))[0]
+
+    async def get_many(self, deployment: str, questions: List[str]) -> List[Optional[List[float]]]:
+        """Cached vectors for `questions` in order, None for misses; disk misses share one thread hop."""
+        keys = [(deployment, normalise_question(q)) for q in questions]
+        now = time.time()
+        with self._lock:
+            results = [self._from_memory(key, now) for key in keys]
+        missing = [i for i, vector in enumerate(results) if vector is None]
+        if missing and self._db is not None:
+            rows = await asyncio.to_thread(self._read_disk, [keys[i] for i in missing])
+            with self._lock:
+                for i, row in zip(missing, rows):
+                    if row is not None and now - row[1] < self.ttl_seconds:
+                        results[i] = array("f", row[0]).tolist()
+                        self._remember(keys[i], results[i], row[1])
+        return results
+
+    async def put(self, deployment: str, question: str, embedding: List[float]) -> None:
+        key = (deployment, normalise_question(question))
+        now = time.time()
+        with self._lock:
+            self._remember(key, list(embedding), now)
+        if self._db is not None:
+            await asyncio.to_thread(self._write_disk, key, array("f", embedding).tobytes(), now)
+
+    def _from_memory(self, key, now):
+        entry = self._memory.get(key)
+        if entry is None:
+            return None
+        vector, created_at = entry
+        if now - created_at < self.ttl_seconds:
+            self._memory.move_to_end(key)
+            return vector
+        del self._memory[key]
+        return None
+
+    def _read_disk(self, keys):
+        with self._db_lock:
+            try:
+                return [
+                    self._db.execute(
+                        "SELECT vector, created_at FROM embeddings WHERE deployment = ? AND question = ?",
+                        key,
+                    ).fetchone()
+                    for key in keys
+                ]
+            except sqlite3.Error as e:
+                print(f"WARN: embedding cache read failed: {e}")
+                return [None] * len(keys)
+
+    def _write_disk(self, key, blob, now):
+        with self._db_lock:
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO embeddings (deployment, question, vector, created_at) VALUES (?, ?, ?, ?)",
+                    (key[0], key[1], blob, now),
+                )
+                self._writes_since_prune += 1
+                if self._writes_since_prune >= self._PRUNE_EVERY:
+                    self._prune(now)
+            except sqlite3.Error as e:
+                print(f"WARN: embedding cache write failed: {e}")
+
+    def _remember(self, key, vector, created_at):
+        self._memory[key] = (vector, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _prune(self, now: float):
+        self._writes_since_prune = 0
+        self._db.execute("DELETE FROM embeddings WHERE created_at < ?", (now - self.ttl_seconds,))
+        self._db.execute(
+            "DELETE FROM embeddings WHERE rowid IN ("
+            " SELECT rowid FROM embeddings ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_disk_entries,),
+        )
@@ -0,0 +1,136 @@
+"""history_compactor.py
+
+Keeps the conversation history sent to the LLM bounded however long a session runs.
+
+The most recent turns (a user message plus the replies that follow it) are kept verbatim. Everything
+older is folded into a rolling summary. Summaries are cached under a fingerprint of the conversation
+prefix they cover, a hash chained message by message, so a follow-up in the same session finds the
+summary from its previous request and only the turns that have just fallen out of the window are
+folded in. The whole block, summary included, stays under a hard token ceiling.
+"""
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, List, Optional
+
+from context_packer import count_tokens, truncate_to_last_tokens, truncate_to_tokens
+from metrics import record_cache
+
+SUMMARY_LABEL = "Summary of earlier conversation:"
+
+
+def format_messages(messages) -> str:
+    return "\n".join(f"{msg.role}: {msg.content}" for msg in messages)
+
+
+def split_turns(messages) -> List[list]:
+    """Groups messages into turns, each starting at a user message."""
+    turns = []
+    for msg in messages:
+        if msg.role == "user" or not turns:
+            turns.append([])
+        turns[-1].append(msg)
+    return turns
+
+
+def prefix_fingerprints(messages) -> List[str]:
+    """One fingerprint per message, covering the conversation up to and including it."""
+    fingerprints, digest = [], b""
+    for msg in messages:
+        digest = hashlib.sha256(digest + f"{msg.role}\x00{msg.content}\x00".encode("utf-8")).digest()
+        fingerprints.append(digest.hex())
+    return fingerprints
+
+
+class HistoryCompactor:
+    """
+    `summarize(previous_summary, messages)` is called to fold `messages` into `previous_summary`
+    (empty for a new conversation) and should return the new summary text.
+    """
+
+    def __init__(self, summarize: Callable[[str, list], Awaitable[str]], recent_turns: int = 3,
+                 token_limit: int = 1500, summary_tokens: int = 300, max_entries: int = 4096):
+        self.summarize = summarize
+        self.recent_turns = recent_turns
+        self.token_limit = token_limit
+        self.summary_tokens = min(summary_tokens, token_limit)
+        self.max_entries = max_entries
+        self._summaries = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    async def compact(self, messages) -> str:
+        """History text for a prompt: the rolling summary (if any) followed by the recent turns."""
+        turns = split_turns(messages or [])
+        if not turns:
+            return ""
+
+        recent_budget = self.token_limit - self.summary_tokens
+        kept, used = 0, 0
+        for turn in reversed(turns[-self.recent_turns:] if self.recent_turns > 0 else []):
+            size = count_tokens(format_messages(turn))
+            if kept and used + size > recent_budget:
+                break
+            kept, used = kept + 1, used + size
+
+        older = [msg for turn in turns[:len(turns) - kept] for msg in turn]
+        recent = format_messages(msg for turn in turns[len(turns) - kept:] for msg in turn)
+        if not older:
+            return truncate_to_last_tokens(recent, self.token_limit)
+
+        summary = await self._summary_for(older)
+        # The newest turn is what the rewrite depends on most, so an oversize window loses its start.
+        recent = truncate_to_last_tokens(recent, recent_budget)
+        if not summary:
+            return recent
+        return f"{SUMMARY_LABEL} {summary}\n{recent}".rstrip()
+
+    async def _summary_for(self, older) -> str:
+        fingerprints = prefix_fingerprints(older)
+        key = fingerprints[-1]
+        cached = self._get(key)
+        record_cache("history_summary", cached is not None)
+        if cached is not None:
+            return cached
+
+        # Another request for the same conversation may already be summarising this prefix.
+        with self._lock:
+            task = self._in_flight.get(key)
+            if task is None:
+                task = asyncio.ensure_future(self._fold(older, fingerprints))
+                self._in_flight[key] = task
+                task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _fold(self, older, fingerprints) -> str:
+        start, previous = 0, ""
+        for i in range(len(fingerprints) - 2, -1, -1):
+            cached = self._get(fingerprints[i])
+            if cached is not None:
+                start, previous = i + 1, cached
+                break
+        try:
+            summary = await self.summarize(previous, older[start:])
+        except Exception as e:
+            # Without a fresh summary the evicted turns are dropped; the recent window still goes out.
+            print(f"WARN: History summary failed, using the previous summary: {e}")
+            return previous
+        summary = truncate_to_tokens((summary or "").strip(), self.summary_tokens)
+        self._put(fingerprints[-1], summary)
+        print(f"LOG: Folded {len(older) - start} message(s) into the history summary ({count_tokens(summary)} tokens).")
+        return summary
+
+    def _get(self, key: str) -> Optional[str]:
+        with self._lock:
+            value = self._summaries.get(key)
+            if value is not None:
+                self._summaries.move_to_end(key)
+            return value
+
+    def _put(self, key: str, value: str) -> None:
+        with self._lock:
+            self._summaries[key] = value
+            self._summaries.move_to_end(key)
+            while len(self._summaries) > self.max_entries:
+                self._summaries.popitem(last=False)
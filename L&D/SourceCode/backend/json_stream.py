@@ -0,0 +1,79 @@
+"""json_stream.py
+
+Incremental extraction of one string field from a JSON object that is still being generated.
+
+The answer prompt asks the model for a JSON object, so a streamed completion arrives as fragments of
+JSON text. JsonStringFieldStreamer is fed those fragments and returns the newly decoded characters of
+the target field (e.g. "answer") as soon as they are available, handling escape sequences that are
+split across fragments.
+"""
+import json
+import re
+
+_SIMPLE_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+class JsonStringFieldStreamer:
+    """Feeds raw JSON text in and yields the decoded value of a top-level string field."""
+
+    def __init__(self, field: str):
+        self._opening = re.compile(r'"' + re.escape(field) + r'"\s*:\s*"')
+        self._buffer = ""
+        self._pos = 0
+        self._state = "seek"
+        self._pending_high_surrogate = ""
+
+    @property
+    def done(self) -> bool:
+        return self._state == "done"
+
+    def feed(self, fragment: str) -> str:
+        self._buffer += fragment
+        if self._state == "seek":
+            match = self._opening.search(self._buffer)
+            if not match:
+                return ""
+            self._pos = match.end()
+            self._state = "value"
+        if self._state != "value":
+            return ""
+
+        out = []
+        buffer = self._buffer
+        while self._pos < len(buffer):
+            char = buffer[self._pos]
+            if char == '"':
+                self._state = "done"
+                self._pos += 1
+                break
+            if char != "\\":
+                out.append(char)
+                self._pos += 1
+                continue
+            if self._pos + 1 >= len(buffer):
+                break  # wait for the rest of the escape sequence
+            code = buffer[self._pos + 1]
+            if code in _SIMPLE_ESCAPES:
+                out.append(_SIMPLE_ESCAPES[code])
+                self._pos += 2
+            elif code == "u":
+                if self._pos + 6 > len(buffer):
+                    break
+                out.append(self._decode_unicode(buffer[self._pos:self._pos + 6]))
+                self._pos += 6
+            else:
+                # Invalid escape; keep the character rather than stalling the stream.
+                out.append(code)
+                self._pos += 2
+        return "".join(out)
+
+    def _decode_unicode(self, escape: str) -> str:
+        unit = int(escape[2:], 16)
+        if 0xD800 <= unit <= 0xDBFF:
+            self._pending_high_surrogate = escape
+            return ""
+        if 0xDC00 <= unit <= 0xDFFF and self._pending_high_surrogate:
+            pair = self._pending_high_surrogate + escape
+            self._pending_high_surrogate = ""
+            return json.loads(f'"{pair}"')
+        return chr(unit)
@@ -0,0 +1,198 @@
+"""local_index.py
+
+In-process exact vector index for small corpora such as a single training manual.
+
+On disk an index is a directory holding:
+    meta.json            dimensions, point count, source collection and build time
+    ids.json             point ids in row order (ints or strings, as stored in Qdrant)
+    vectors.f32          row-major float32 matrix of L2-normalised vectors
+    vectors.i8           optional int8 copy of the matrix, with per-row scales in scales.f32
+    payloads.bin         UTF-8 JSON payloads laid end to end
+    payload_offsets.npy  uint64 offsets into payloads.bin, one more than the number of rows
+
+The matrices are memory-mapped, so loading is instant and several workers share the page cache.
+Search is a single matrix-vector product followed by an argpartition.
+
+Build an index with:
+    python local_index.py --from-qdrant --collection <name> --out <dir> [--int8]
+    python local_index.py --from-json extracted_content.json --collection <name> --out <dir> [--int8]
+"""
+import argparse
+import json
+import os
+import shutil
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# Candidates rescored with float32 per requested hit when scanning the int8 matrix.
+INT8_RESCORE_FACTOR = 4
+
+
+class LocalVectorIndex:
+    """Memory-mapped exact top-k search over normalised vectors with an array-backed payload store."""
+
+    def __init__(self, index_dir: str, use_int8: bool = False):
+        with open(os.path.join(index_dir, "meta.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        with open(os.path.join(index_dir, "ids.json"), encoding="utf-8") as f:
+            self.ids = json.load(f)
+        count, dim = self.meta["count"], self.meta["dim"]
+        self.vectors = np.memmap(os.path.join(index_dir, "vectors.f32"), dtype=np.float32, mode="r", shape=(count, dim))
+
+        self.int8_vectors = None
+        if use_int8:
+            int8_path = os.path.join(index_dir, "vectors.i8")
+            if not os.path.exists(int8_path):
+                raise FileNotFoundError(f"Index at {index_dir} was built without --int8.")
+            self.int8_vectors = np.memmap(int8_path, dtype=np.int8, mode="r", shape=(count, dim))
+            self.int8_scales = np.fromfile(os.path.join(index_dir, "scales.f32"), dtype=np.float32)
+
+        self._payloads = np.memmap(os.path.join(index_dir, "payloads.bin"), dtype=np.uint8, mode="r")
+        self._payload_offsets = np.load(os.path.join(index_dir, "payload_offsets.npy"))
+        self._row_by_id = {point_id: row for row, point_id in enumerate(self.ids)}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, query_vector: List[float], top_k: int) -> List[tuple]:
+        """Returns (row, cosine score) pairs, best first."""
+        if not len(self) or top_k <= 0:
+            return []
+        query = np.asarray(query_vector, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+
+        if self.int8_vectors is not None:
+            approx = (self.int8_vectors @ query) * self.int8_scales
+            candidates = _top_rows(approx, top_k * INT8_RESCORE_FACTOR)
+            scores = self.vectors[candidates] @ query
+            order = np.argsort(-scores)[:top_k]
+            return [(int(candidates[i]), float(scores[i])) for i in order]
+
+        scores = self.vectors @ query
+        rows = _top_rows(scores, top_k)
+        return [(int(row), float(scores[row])) for row in rows]
+
+    def payload(self, row: int) -> dict:
+        start, end = self._payload_offsets[row], self._payload_offsets[row + 1]
+        return json.loads(self._payloads[start:end].tobytes().decode("utf-8"))
+
+    def row_of(self, point_id) -> Optional[int]:
+        return self._row_by_id.get(point_id)
+
+
+def _top_rows(scores: np.ndarray, k: int) -> np.ndarray:
+    k = min(k, len(scores))
+    rows = np.argpartition(-scores, k - 1)[:k]
+    return rows[np.argsort(-scores[rows])]
+
+
+def write_index(index_dir: str, ids: List, vectors: List[List[float]], payloads: List[Dict], collection: str, with_int8: bool = False):
+    """Writes a new index directory, replacing any existing one only once it is complete."""
+    matrix = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix /= np.where(norms == 0, 1.0, norms)
+
+    staging_dir = index_dir.rstrip("/\\") + ".building"
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    os.makedirs(staging_dir)
+
+    matrix.tofile(os.path.join(staging_dir, "vectors.f32"))
+    if with_int8:
+        scales = np.abs(matrix).max(axis=1) / 127.0
+        scales = np.where(scales == 0, 1.0, scales).astype(np.float32)
+        np.round(matrix / scales[:, None]).astype(np.int8).tofile(os.path.join(staging_dir, "vectors.i8"))
+        scales.tofile(os.path.join(staging_dir, "scales.f32"))
+
+    offsets = [0]
+    with open(os.path.join(staging_dir, "payloads.bin"), "wb") as f:
+        for payload in payloads:
+            data = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            f.write(data)
+            offsets.append(offsets[-1] + len(data))
+    np.save(os.path.join(staging_dir, "payload_offsets.npy"), np.asarray(offsets, dtype=np.uint64))
+
+    with open(os.path.join(staging_dir, "ids.json"), "w", encoding="utf-8") as f:
+        json.dump(ids, f)
+    with open(os.path.join(staging_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "collection": collection,
+            "count": len(ids),
+            "dim": int(matrix.shape[1]) if len(ids) else 0,
+            "int8": with_int8,
+            "built_at": time.time(),
+        }, f, indent=2)
+
+    shutil.rmtree(index_dir, ignore_errors=True)
+    os.replace(staging_dir, index_dir)
+    print(f"Wrote local index with {len(ids)} vectors to '{index_dir}'.")
+
+
+def build_from_qdrant(qdrant_url: str, collection: str, index_dir: str, with_int8: bool = False):
+    """Exports every point of a Qdrant collection (e.g. one restored from a snapshot) into a local index."""
+    from qdrant_client import QdrantClient
+
+    client = QdrantClient(qdrant_url)
+    ids, vectors, payloads = [], [], []
+    offset = None
+    while True:
+        points, offset = client.scroll(
+            collection_name=collection, limit=256, offset=offset, with_payload=True, with_vectors=True
+        )
+        for point in points:
+            ids.append(point.id)
+            vectors.append(point.vector)
+            payloads.append(point.payload)
+        if offset is None:
+            break
+    write_index(index_dir, ids, vectors, payloads, collection, with_int8)
+
+
+def build_from_json(json_path: str, collection: str, index_dir: str, with_int8: bool = False, batch_size: int = 64):
+    """Embeds the chunks of an extracted-content JSON file with Azure and writes a local index.
+
+    Point ids follow ingest_to_qdrant (point_ids.chunk_point_id), so hybrid search can share its BM25 index.
+    """
+    import openai
+
+    from point_ids import with_point_ids
+
+    client = openai.AzureOpenAI(
+        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+        api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
+    )
+    with open(json_path, "r", encoding="utf-8") as f:
+        ids, chunks = zip(*with_point_ids(chunk for chunk in json.load(f) if chunk.get("content")))
+
+    vectors = []
+    for start in range(0, len(chunks), batch_size):
+        batch = chunks[start:start + batch_size]
+        response = client.embeddings.create(
+            input=[chunk["content"] for chunk in batch],
+            model=os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT"),
+        )
+        vectors.extend(item.embedding for item in sorted(response.data, key=lambda d: d.index))
+        print(f"Embedded {len(vectors)}/{len(chunks)} chunks...")
+    write_index(index_dir, list(ids), vectors, list(chunks), collection, with_int8)
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Build a local vector index for the L&D backend.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--from-qdrant", action="store_true", help="Export the vectors from a Qdrant collection.")
+    source.add_argument("--from-json", metavar="PATH", help="Embed the chunks of an extracted-content JSON file.")
+    parser.add_argument("--collection", required=True)
+    parser.add_argument("--out", required=True, help="Index directory to create or replace.")
+    parser.add_argument("--qdrant-url", default="http://localhost:6333")
+    parser.add_argument("--int8", action="store_true", help="Also write an int8 copy of the matrix.")
+    args = parser.parse_args()
+
+    if args.from_qdrant:
+        build_from_qdrant(args.qdrant_url, args.collection, args.out, args.int8)
+    else:
+        build_from_json(args.from_json, args.collection, args.out, args.int8)
@@ -0,0 +1,192 @@
+"""manual_registry.py
+
+Registry of the training manuals served by this backend and the router that picks which manual
+collections to search for a question.
+
+The registry is a JSON list (manuals.json by default), one entry per Qdrant collection:
+    [{"collection": "...", "document": "Connect ... v25.0.pdf", "title": "Investigation Management"}]
+
+Routing uses a small centroid index: the mean of each collection's normalised chunk vectors, saved
+as an .npz file. A question is compared against every centroid (one tiny matrix-vector product)
+and only the ROUTER_MAX_COLLECTIONS closest collections are searched, in parallel, so latency stays
+flat as manuals are added. Collections without a centroid are always searched.
+
+Hits from several collections are merged by reciprocal rank fusion over each collection's own
+ranking, not by raw score: a hybrid or typed retriever orders its hits by fused rank and slot, and
+the cosine score left on each hit does not reflect that order.
+
+Build or refresh the centroid index with:
+    python manual_registry.py --build-centroids [--qdrant-url http://localhost:6333]
+"""
+import argparse
+import asyncio
+import json
+import os
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+from bm25_index import reciprocal_rank_fusion
+
+
+class UnknownManualError(ValueError):
+    """Raised when a request filters on manuals that are not in the registry."""
+
+
+class ManualRegistry:
+    def __init__(self, manuals: List[dict], centroid_path: Optional[str] = None):
+        self.manuals = {m["collection"]: m for m in manuals}
+        self.centroid_path = centroid_path
+        self._centroid_collections = []
+        self._centroids = None
+        if centroid_path and os.path.exists(centroid_path):
+            self._load_centroids(centroid_path)
+
+    @classmethod
+    def load(cls, path: str, default_manual: dict, centroid_path: Optional[str] = None) -> "ManualRegistry":
+        """Reads the registry file; without one, serves just `default_manual`."""
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                manuals = json.load(f)
+        else:
+            manuals = [default_manual]
+        print(f"Manual registry: {len(manuals)} manual(s) - {', '.join(m['collection'] for m in manuals)}")
+        return cls(manuals, centroid_path)
+
+    @property
+    def collections(self) -> List[str]:
+        return list(self.manuals)
+
+    def document_for(self, collection: str) -> str:
+        manual = self.manuals.get(collection)
+        return manual.get("document", collection) if manual else collection
+
+    def validate(self, manuals: Optional[List[str]]) -> None:
+        unknown = [m for m in manuals or [] if m not in self.manuals]
+        if unknown:
+            raise UnknownManualError(f"Unknown manual(s): {', '.join(unknown)}")
+
+    def route(self, embedding, manuals: Optional[List[str]] = None, max_collections: int = 3) -> List[str]:
+        """Collections to search for this question, best candidates first."""
+        if manuals:
+            self.validate(manuals)
+            candidates = list(dict.fromkeys(manuals))
+        else:
+            candidates = self.collections
+        if len(candidates) <= max_collections or self._centroids is None:
+            return candidates
+
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        scores = dict(zip(self._centroid_collections, (self._centroids @ query).tolist()))
+        unranked = [c for c in candidates if c not in scores]
+        ranked = sorted((c for c in candidates if c in scores), key=lambda c: -scores[c])
+        return unranked + ranked[:max(max_collections - len(unranked), 1)]
+
+    def _load_centroids(self, path: str):
+        with np.load(path, allow_pickle=False) as data:
+            self._centroid_collections = data["collections"].tolist()
+            self._centroids = data["centroids"].astype(np.float32)
+        print(f"Loaded centroids for {len(self._centroid_collections)} manual collection(s).")
+
+
+def write_centroids(path: str, centroids: Dict[str, np.ndarray]):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    collections = list(centroids)
+    matrix = np.asarray([centroids[c] for c in collections], dtype=np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True).clip(min=1e-12)
+    with open(path, "wb") as f:
+        np.savez(f, collections=np.asarray(collections, dtype=np.str_), centroids=matrix)
+    print(f"Wrote centroids for {len(collections)} collection(s) to '{path}'.")
+
+
+def collection_centroid(qdrant_client, collection: str) -> np.ndarray:
+    """Mean of the normalised vectors of every point in a Qdrant collection."""
+    total, offset = None, None
+    while True:
+        points, offset = qdrant_client.scroll(
+            collection_name=collection, limit=256, offset=offset, with_payload=False, with_vectors=True
+        )
+        if points:
+            vectors = np.asarray([p.vector for p in points], dtype=np.float32)
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True).clip(min=1e-12)
+            total = vectors.sum(axis=0) if total is None else total + vectors.sum(axis=0)
+        if offset is None:
+            return total
+
+
+class ManualRouter:
+    """
+    Retriever over every registered manual. Implements the retrievers.py interface plus an optional
+    `manuals` filter, and tags each hit's payload with the collection it came from.
+    """
+
+    def __init__(self, registry: ManualRegistry, retriever_factory: Callable[[str], object], max_collections: int = 3,
+                 rrf_k: int = 60):
+        self.registry = registry
+        self.retriever_factory = retriever_factory
+        self.max_collections = max_collections
+        self.rrf_k = rrf_k
+        self._retrievers = {}
+
+    def retriever_for(self, collection: str):
+        if collection not in self._retrievers:
+            self._retrievers[collection] = self.retriever_factory(collection)
+        return self._retrievers[collection]
+
+    async def search(self, embedding, top_k: int, query_text: str = None, manuals: Optional[List[str]] = None):
+        collections = self.registry.route(embedding, manuals, self.max_collections)
+        if len(collections) == 1:
+            return _tag(collections[0], await self.retriever_for(collections[0]).search(embedding, top_k, query_text))
+        per_collection = await asyncio.gather(*(
+            self.retriever_for(c).search(embedding, top_k, query_text) for c in collections
+        ))
+        hits = {(c, hit.id): hit for c, result in zip(collections, per_collection) for hit in _tag(c, result)}
+        fused = reciprocal_rank_fusion(
+            [[(c, hit.id) for hit in result] for c, result in zip(collections, per_collection)], self.rrf_k
+        )
+        return [hits[key] for key, _score in fused[:top_k]]
+
+    async def search_batch(self, embeddings, top_ks, query_texts=None, manuals_per_query=None):
+        query_texts = query_texts or [None] * len(embeddings)
+        manuals_per_query = manuals_per_query or [None] * len(embeddings)
+        routes = [self.registry.route(e, m, self.max_collections) for e, m in zip(embeddings, manuals_per_query)]
+        if all(len(route) == 1 and route == routes[0] for route in routes):
+            results = await self.retriever_for(routes[0][0]).search_batch(embeddings, top_ks, query_texts)
+            return [_tag(routes[0][0], result) for result in results]
+        return await asyncio.gather(*(
+            self.search(e, k, t, m) for e, k, t, m in zip(embeddings, top_ks, query_texts, manuals_per_query)
+        ))
+
+    async def fingerprint(self) -> str:
+        fingerprints = await asyncio.gather(*(self.retriever_for(c).fingerprint() for c in self.registry.collections))
+        return "|".join(fingerprints)
+
+
+def _tag(collection: str, hits):
+    for hit in hits:
+        hit.payload = {**(hit.payload or {}), "collection": collection}
+    return hits
+
+
+if __name__ == "__main__":
+    from qdrant_client import QdrantClient
+
+    parser = argparse.ArgumentParser(description="Build the manual routing centroid index.")
+    parser.add_argument("--build-centroids", action="store_true", required=True)
+    parser.add_argument("--registry", default=os.getenv("MANUAL_REGISTRY_PATH", os.path.join(os.path.dirname(__file__), "manuals.json")))
+    parser.add_argument("--out", default=os.getenv("MANUAL_CENTROIDS_PATH", os.path.join(os.path.dirname(__file__), ".cache", "manual_centroids.npz")))
+    parser.add_argument("--qdrant-url", default="http://localhost:6333")
+    args = parser.parse_args()
+
+    with open(args.registry, "r", encoding="utf-8") as f:
+        registered = [m["collection"] for m in json.load(f)]
+    client = QdrantClient(args.qdrant_url)
+    centroids = {}
+    for name in registered:
+        centroid = collection_centroid(client, name)
+        if centroid is None:
+            print(f"Skipping '{name}': collection is empty.")
+            continue
+        centroids[name] = centroid
+    write_centroids(args.out, centroids)
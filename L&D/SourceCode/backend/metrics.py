@@ -0,0 +1,93 @@
+"""metrics.py
+
+Per-stage latency, token and cache instrumentation for the L&D API.
+
+Stages are timed with `stage("name")` around each step of the pipeline (rewrite, embedding,
+retrieval, completion, ...). Every measurement goes to a Prometheus histogram served on /metrics,
+and is also added to the timings of the HTTP request it belongs to, which api.py returns as a
+Server-Timing header. The per-request timings live in a context variable set by the API middleware,
+so the pipeline code never passes them around.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+
+STAGE_SECONDS = Histogram(
+    "ld_stage_duration_seconds",
+    "Time spent in each stage of the RAG pipeline.",
+    ["stage"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+REQUEST_SECONDS = Histogram(
+    "ld_request_duration_seconds",
+    "End-to-end handler time per API route.",
+    ["route"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0),
+)
+LLM_TOKENS = Histogram(
+    "ld_llm_tokens",
+    "Prompt and completion tokens per LLM call.",
+    ["stage", "kind"],
+    buckets=(16, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384),
+)
+CACHE_LOOKUPS = Counter(
+    "ld_cache_lookups_total",
+    "Cache lookups by cache and outcome.",
+    ["cache", "result"],
+)
+
+_request_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("ld_request_timings", default=None)
+
+
+def start_request() -> Dict[str, float]:
+    """Starts collecting stage timings for the current request and returns the (live) timings dict."""
+    timings = {}
+    _request_timings.set(timings)
+    return timings
+
+
+def observe_stage(name: str, seconds: float) -> None:
+    STAGE_SECONDS.labels(name).observe(seconds)
+    timings = _request_timings.get()
+    if timings is not None:
+        # Concurrent work in one request (batch items, speculative retrieval) adds up per stage.
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+@contextmanager
+def stage(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - started)
+
+
+def record_tokens(stage_name: str, prompt_tokens: Optional[int], completion_tokens: Optional[int]) -> None:
+    if prompt_tokens is not None:
+        LLM_TOKENS.labels(stage_name, "prompt").observe(prompt_tokens)
+    if completion_tokens is not None:
+        LLM_TOKENS.labels(stage_name, "completion").observe(completion_tokens)
+
+
+def record_usage(stage_name: str, response) -> None:
+    """Records the token usage reported on an OpenAI response, if any."""
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        record_tokens(stage_name, getattr(usage, "prompt_tokens", None), getattr(usage, "completion_tokens", None))
+
+
+def record_cache(cache: str, hit: bool) -> None:
+    CACHE_LOOKUPS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def server_timing_header(timings: Dict[str, float]) -> str:
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items())
+
+
+def render_latest():
+    """Body and content type for the /metrics endpoint."""
+    return generate_latest(), CONTENT_TYPE_LATEST
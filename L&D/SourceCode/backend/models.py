@@ -15,6 +15,7 @@ class UserQuery(BaseModel):
     top_k: int = Field(3, description="The number of documents to retrieve.")
     history: List[ChatMessage] = Field(default_factory=list, description="A list of previous user and assistant messages.")
     case_context: Optional[CaseContext] = Field(None, description="Optional details about the current case being worked on.")
+    manuals: Optional[List[str]] = Field(None, description="Optional list of manual collections to restrict the search to.")
 
 class ValidatedSource(BaseModel):
     document: str
@@ -37,11 +38,17 @@ class ApiResponse(BaseModel):
     validated_sources: List[ValidatedSource]
     raw_sources: Optional[List[RawSource]]= Field(default_factory=list)
 
+class BatchItemResult(BaseModel):
+    index: int = Field(..., description="Position of the query in the batch request.")
+    response: Optional[ApiResponse] = None
+    error: Optional[str] = Field(None, description="Set instead of response when this query failed.")
+
 class SuggestQuestionsRequest(BaseModel):
     case_context: Optional[CaseContext] = None
     top_k: int = 5
+    use_llm: bool = Field(False, description="Generate suggestions with the LLM instead of the precomputed question bank.")
 
 class SuggestQuestionsResponse(BaseModel):
-    question: str
+    question: str = Field(..., description="The standalone question the manual was searched with; empty when the suggestions came from the question bank, which needs no rewrite.")
     suggested_questions: List[str]
     raw_sources: Optional[List[RawSource]] = Field(default_factory=list)
\ No newline at end of file
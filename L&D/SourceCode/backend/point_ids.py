@@ -0,0 +1,38 @@
+"""point_ids.py
+
+Stable Qdrant point ids for manual chunks.
+
+A chunk's id is a UUIDv5 of its document, section number, type and content, so re-ingesting an
+unchanged chunk always produces the same id and any edit to it produces a new one. Ingest compares
+these ids with the ones already in the collection to decide what to embed, upsert and delete.
+"""
+import uuid
+from typing import Iterable, Iterator, Tuple
+
+# Fixed namespace for chunk ids; changing it would re-key every collection.
+_CHUNK_NAMESPACE = uuid.UUID("1214336f-0487-441c-9bbb-ce6677e96457")
+
+# Payload fields that identify where a chunk lives in a manual, independent of its text.
+IDENTITY_FIELDS = ("document", "section_number", "type")
+
+
+def chunk_point_id(chunk: dict) -> str:
+    key = "\x00".join(str(chunk.get(field) or "") for field in IDENTITY_FIELDS + ("content",))
+    return str(uuid.uuid5(_CHUNK_NAMESPACE, key))
+
+
+def chunk_identity(chunk: dict) -> Tuple[str, ...]:
+    return tuple(str(chunk.get(field) or "") for field in IDENTITY_FIELDS)
+
+
+def with_point_ids(chunks: Iterable[dict], warn: bool = True) -> Iterator[Tuple[str, dict]]:
+    """Yields (point id, chunk) pairs in input order; exact duplicate chunks are kept once."""
+    seen = set()
+    for chunk in chunks:
+        point_id = chunk_point_id(chunk)
+        if point_id in seen:
+            if warn:
+                print(f"WARN: Skipping duplicate chunk in section {chunk.get('section_number')} ({chunk.get('type')}).")
+            continue
+        seen.add(point_id)
+        yield point_id, chunk
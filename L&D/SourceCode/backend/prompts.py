@@ -93,4 +93,33 @@ Manual Content:
 {manual_content}
 
 Return ONLY a numbered list of questions.
-"""
\ No newline at end of file
+"""
+
+# Prompt to fold turns that have left the recent-history window into the rolling conversation summary.
+HISTORY_SUMMARY_PROMPT = """
+You maintain a running summary of a conversation between a police officer and a training-manual assistant.
+Update the summary with the new messages below. Keep the Connect screens, tasks, section numbers and case details that were
+discussed, what the officer was trying to do, and any answer they are still following. Drop pleasantries and repetition.
+Write at most {max_words} words of plain prose. ONLY return the updated summary, with no other text or explanation.
+
+Current Summary:
+{previous_summary}
+
+New Messages:
+{new_messages}
+
+Updated summary:
+"""
+
+
+# Prompt used offline by question_bank.py to seed the suggested-question bank, one manual section at a time.
+QUESTION_BANK_PROMPT = """
+You are helping police officers learn the Connect system. Read the training manual section below and write {count} distinct
+questions an officer working a case might ask that this section answers. Each question must make sense on its own, without
+the section in front of the reader. Cover different tasks in the section rather than rephrasing the same question.
+
+Section {section_number}: {section_title}
+{content}
+
+Return ONLY a numbered list of questions.
+"""
@@ -0,0 +1,209 @@
+"""question_bank.py
+
+Precomputed bank of suggested questions, so /manual/suggest-questions can answer without a chat call.
+
+An offline job asks the chat deployment for a handful of questions an officer might ask about each
+manual section, embeds them and stores them in a companion Qdrant collection named
+"<collection>__questions". At request time the case context is embedded once, the bank is searched
+for a few times more candidates than needed, and maximal marginal relevance (MMR) picks questions
+that are relevant to the case but not near-duplicates of each other.
+
+Which manuals have a bank is remembered for a few minutes, so a deployment without one does not pay
+for an embedding call and a failing search on every request before falling back to the LLM.
+
+Build or refresh the bank for every registered manual with:
+    python question_bank.py --build [--collection <name>] [--questions-per-section 5]
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from typing import List
+
+import numpy as np
+
+QUESTION_BANK_SUFFIX = "__questions"
+
+
+def bank_collection(collection: str) -> str:
+    return f"{collection}{QUESTION_BANK_SUFFIX}"
+
+
+def parse_numbered_questions(raw_output: str) -> List[str]:
+    questions = []
+    for line in raw_output.split('\n'):
+        line = line.strip()
+        if line and (line[0].isdigit() or line.startswith('-')):
+            q = line.split('.', 1)[-1].strip() if '.' in line else line.lstrip('-').strip()
+            if q:
+                questions.append(q)
+    return questions
+
+
+def mmr(query_vector, candidate_vectors, top_k: int, diversity: float = 0.3) -> List[int]:
+    """Indices of `top_k` candidates chosen by maximal marginal relevance, in pick order."""
+    if not len(candidate_vectors) or top_k <= 0:
+        return []
+    matrix = np.asarray(candidate_vectors, dtype=np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True).clip(min=1e-12)
+    query = np.asarray(query_vector, dtype=np.float32)
+    query /= np.linalg.norm(query) or 1.0
+
+    relevance = matrix @ query
+    picked = [int(np.argmax(relevance))]
+    redundancy = matrix @ matrix[picked[0]]
+    while len(picked) < min(top_k, len(matrix)):
+        scores = (1 - diversity) * relevance - diversity * redundancy
+        scores[picked] = -np.inf
+        best = int(np.argmax(scores))
+        picked.append(best)
+        redundancy = np.maximum(redundancy, matrix @ matrix[best])
+    return picked
+
+
+class QuestionBank:
+    """Searches the "<collection>__questions" collections of the routed manuals."""
+
+    def __init__(self, client, candidate_factor: int = 4, diversity: float = 0.3, recheck_seconds: float = 300.0):
+        self.client = client
+        self.candidate_factor = candidate_factor
+        self.diversity = diversity
+        self.recheck_seconds = recheck_seconds
+        self._available = {}
+
+    async def available(self, collections: List[str]) -> List[str]:
+        """The collections among `collections` that have a bank, re-checked every `recheck_seconds`."""
+        now = time.monotonic()
+        stale = [c for c in collections if now - self._available.get(c, (False, -float("inf")))[1] >= self.recheck_seconds]
+        if stale:
+            exists = await asyncio.gather(
+                *(self.client.collection_exists(bank_collection(c)) for c in stale), return_exceptions=True
+            )
+            for c, found in zip(stale, exists):
+                self._available[c] = (found is True, now)
+        return [c for c in collections if self._available[c][0]]
+
+    async def suggest(self, embedding, collections: List[str], top_k: int) -> List[dict]:
+        """Returns up to `top_k` diverse bank payloads; empty when no bank has been built."""
+        collections = await self.available(collections)
+        if not collections:
+            return []
+        limit = max(top_k * self.candidate_factor, top_k)
+        per_collection = await asyncio.gather(*(
+            self.client.search(
+                collection_name=bank_collection(c),
+                query_vector=embedding,
+                limit=limit,
+                with_payload=True,
+                with_vectors=True,
+            )
+            for c in collections
+        ))
+        hits, seen = [], set()
+        for hit in sorted((h for result in per_collection for h in result), key=lambda h: -h.score)[:limit]:
+            text = (hit.payload or {}).get("question", "").strip()
+            if text and text.lower() not in seen:
+                seen.add(text.lower())
+                hits.append(hit)
+        picked = mmr(embedding, [h.vector for h in hits], top_k, self.diversity)
+        return [hits[i].payload for i in picked]
+
+
+def build_question_bank(chat_client, qdrant_client, collection: str, questions_per_section: int = 5, batch_size: int = 256):
+    """Generates, embeds and stores the question bank for one manual collection, replacing any old one."""
+    from qdrant_client import models
+
+    from prompts import QUESTION_BANK_PROMPT
+
+    sections, offset = [], None
+    while True:
+        points, offset = qdrant_client.scroll(
+            collection_name=collection, limit=256, offset=offset, with_payload=True, with_vectors=False
+        )
+        sections.extend(p for p in points if (p.payload or {}).get("type", "section") == "section" and (p.payload or {}).get("content"))
+        if offset is None:
+            break
+    print(f"Generating questions for {len(sections)} sections of '{collection}'...")
+
+    entries = []
+    for i, point in enumerate(sections, start=1):
+        payload = point.payload
+        response = chat_client.chat.completions.create(
+            model=os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT"),
+            messages=[{"role": "user", "content": QUESTION_BANK_PROMPT.format(
+                count=questions_per_section,
+                section_number=payload.get("section_number", ""),
+                section_title=payload.get("section_title", ""),
+                content=payload.get("content", ""),
+            )}],
+            temperature=0.3,
+            max_tokens=60 * questions_per_section,
+        )
+        for question in parse_numbered_questions(response.choices[0].message.content.strip())[:questions_per_section]:
+            entries.append({
+                "question": question,
+                "collection": collection,
+                "source_id": point.id,
+                "section_number": payload.get("section_number", "N/A"),
+                "section_title": payload.get("section_title", "N/A"),
+                "page_number": payload.get("page_number", -1),
+            })
+        if i % 25 == 0:
+            print(f"  {i}/{len(sections)} sections, {len(entries)} questions")
+    if not entries:
+        print(f"No questions generated for '{collection}'; leaving the existing bank untouched.")
+        return
+
+    vectors = []
+    for start in range(0, len(entries), batch_size):
+        response = chat_client.embeddings.create(
+            input=[e["question"] for e in entries[start:start + batch_size]],
+            model=os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT"),
+        )
+        vectors.extend(item.embedding for item in sorted(response.data, key=lambda d: d.index))
+
+    target = bank_collection(collection)
+    qdrant_client.recreate_collection(
+        collection_name=target,
+        vectors_config=models.VectorParams(size=len(vectors[0]), distance=models.Distance.COSINE),
+    )
+    for start in range(0, len(entries), batch_size):
+        qdrant_client.upsert(
+            collection_name=target,
+            points=[
+                models.PointStruct(id=start + j, vector=vector, payload=entry)
+                for j, (entry, vector) in enumerate(zip(entries[start:start + batch_size], vectors[start:start + batch_size]))
+            ],
+            wait=True,
+        )
+    print(f"Stored {len(entries)} questions in '{target}'.")
+
+
+if __name__ == "__main__":
+    import openai
+    from dotenv import load_dotenv
+    from qdrant_client import QdrantClient
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Build the suggested-question bank for the L&D backend.")
+    parser.add_argument("--build", action="store_true", required=True)
+    parser.add_argument("--collection", help="Only rebuild this collection (default: every registered manual).")
+    parser.add_argument("--registry", default=os.getenv("MANUAL_REGISTRY_PATH", os.path.join(os.path.dirname(__file__), "manuals.json")))
+    parser.add_argument("--questions-per-section", type=int, default=5)
+    parser.add_argument("--qdrant-url", default="http://localhost:6333")
+    args = parser.parse_args()
+
+    if args.collection:
+        targets = [args.collection]
+    else:
+        with open(args.registry, "r", encoding="utf-8") as f:
+            targets = [m["collection"] for m in json.load(f)]
+    azure = openai.AzureOpenAI(
+        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+        api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
+    )
+    qdrant = QdrantClient(args.qdrant_url)
+    for name in targets:
+        build_question_bank(azure, qdrant, name, args.questions_per_section)
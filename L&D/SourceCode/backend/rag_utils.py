@@ -1,13 +1,27 @@
 # rag_utils.py
+import asyncio
 import json
+import math
 import os
+import time
 from typing import List, Tuple
 
 import openai
-from qdrant_client import QdrantClient
+from qdrant_client import AsyncQdrantClient
 
+from answer_cache import SemanticAnswerCache, section_fingerprint
+from azure_transport import call_with_retry, create_http_client
+from bm25_index import default_index_path
+from collection_profiles import SEARCH_PAYLOAD_FIELDS, payload_selector, search_params
+from context_packer import count_tokens, pack_context
+from embedding_cache import EmbeddingCache
+from history_compactor import HistoryCompactor, format_messages
+from json_stream import JsonStringFieldStreamer
+from manual_registry import ManualRegistry, ManualRouter
+from metrics import observe_stage, record_cache, record_tokens, record_usage, stage
 from models import (
     ApiResponse,
+    BatchItemResult,
     ChatMessage,
     RawSource,
     SuggestQuestionsRequest,
@@ -16,80 +30,555 @@ from models import (
     ValidatedSource,
 )
 from prompts import (
+    HISTORY_SUMMARY_PROMPT,
     REWRITE_PROMPT,
     REWRITE_SUGGESTION_QUESTION_PROMPT,
     SUGGEST_QUESTIONS_PROMPT,
     SYSTEM_PROMPT,
 )
+from question_bank import QuestionBank, parse_numbered_questions
+from retrievers import create_retriever
+from rewrite_policy import RewriteMemo, is_self_contained, rewrite_key
+
+# Upper bound on questions a single worker processes at once. Requests beyond
+# this wait on the event loop instead of tying up a threadpool thread each.
+MAX_CONCURRENT_REQUESTS = int(os.getenv("RAG_MAX_CONCURRENT_REQUESTS", "256"))
+_request_slots = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+# Azure OpenAI transport: one keep-alive pool per worker, sized to its request concurrency, and
+# our own retry policy (call_with_retry) in place of the SDK's. Timeouts are set per stage below.
+AZURE_OPENAI_MAX_CONNECTIONS = int(os.getenv("AZURE_OPENAI_MAX_CONNECTIONS", str(MAX_CONCURRENT_REQUESTS)))
+AZURE_OPENAI_MAX_ATTEMPTS = int(os.getenv("AZURE_OPENAI_MAX_ATTEMPTS", "4"))
+AZURE_OPENAI_RETRY_BASE_DELAY = float(os.getenv("AZURE_OPENAI_RETRY_BASE_DELAY", "0.5"))
+AZURE_OPENAI_RETRY_MAX_DELAY = float(os.getenv("AZURE_OPENAI_RETRY_MAX_DELAY", "20"))
+# Seconds to wait for each kind of call; override with e.g. AZURE_OPENAI_TIMEOUT_COMPLETION=90.
+_DEFAULT_STAGE_TIMEOUTS = {
+    "rewrite": 10.0,
+    "history_summary": 15.0,
+    "embedding": 10.0,
+    "completion": 60.0,
+    "suggest_completion": 30.0,
+}
+STAGE_TIMEOUTS = {
+    stage_name: float(os.getenv(f"AZURE_OPENAI_TIMEOUT_{stage_name.upper()}", str(default)))
+    for stage_name, default in _DEFAULT_STAGE_TIMEOUTS.items()
+}
 
 # --- Client initializations ---
-client = openai.AzureOpenAI(
+client = openai.AsyncAzureOpenAI(
     azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
     api_key=os.getenv("AZURE_OPENAI_API_KEY"),
     api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
+    max_retries=0,
+    http_client=create_http_client(
+        AZURE_OPENAI_MAX_CONNECTIONS,
+        keepalive_expiry=float(os.getenv("AZURE_OPENAI_KEEPALIVE_SECONDS", "60")),
+        connect_timeout=float(os.getenv("AZURE_OPENAI_CONNECT_TIMEOUT", "5")),
+    ),
 )
 
-qdrant_client = QdrantClient("http://localhost:6333")
+# gRPC is preferred for searches: smaller messages and no JSON encoding of the vectors.
+qdrant_client = AsyncQdrantClient(
+    host=os.getenv("QDRANT_HOST", "localhost"),
+    port=int(os.getenv("QDRANT_PORT", "6333")),
+    grpc_port=int(os.getenv("QDRANT_GRPC_PORT", "6334")),
+    prefer_grpc=os.getenv("QDRANT_PREFER_GRPC", "true").lower() == "true",
+)
+# Queried by name; ingest publishes each build as a versioned collection behind an alias of this name
+# (see ingest-to-qdrant/collection_versions.py).
 QDRANT_COLLECTION_NAME = "Connect_Investigation_Training_Manual_v25.0"
 document = "Connect Investigation Training Manual v25.0.pdf"
 
-def ask_rag(query: UserQuery) -> ApiResponse:
+# "qdrant" searches the Qdrant server; "local" searches an in-process index built with local_index.py.
+RETRIEVER_ENGINE = os.getenv("RETRIEVER_ENGINE", "qdrant").lower()
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", os.path.join(os.path.dirname(__file__), ".cache", "local_index"))
+
+# Hybrid retrieval fuses dense hits with the BM25 index written at ingest time. "auto" (and "true")
+# enable it for every collection; "false" turns it off. Searches check the index file every
+# BM25_RELOAD_SECONDS and load it when a collection version is published, whether or not the answer
+# cache is on; a collection whose index does not exist yet is searched dense only until it appears.
+HYBRID_RETRIEVAL = os.getenv("HYBRID_RETRIEVAL", "auto").lower()
+BM25_INDEX_DIR = os.getenv("BM25_INDEX_DIR", os.path.dirname(default_index_path(QDRANT_COLLECTION_NAME)))
+
+# Search-time settings for Qdrant collections built with a collection profile (see collection_profiles.py),
+# and the payload fields fetched with each hit. Set QDRANT_PAYLOAD_FIELDS to an empty string to fetch
+# whole payloads.
+QDRANT_HNSW_EF = int(os.getenv("QDRANT_HNSW_EF", "128"))
+QDRANT_OVERSAMPLING = float(os.getenv("QDRANT_OVERSAMPLING", "2.0"))
+QDRANT_RESCORE = os.getenv("QDRANT_RESCORE", "true").lower() == "true"
+QDRANT_PAYLOAD_FIELDS = [f for f in os.getenv("QDRANT_PAYLOAD_FIELDS", ",".join(SEARCH_PAYLOAD_FIELDS)).split(",") if f.strip()]
+
+# Type-aware retrieval: sections and image captions are searched separately, sections fill top_k, and
+# at most RETRIEVAL_MAX_IMAGES image captions are used per question, attached to their section when it
+# was retrieved. Applies to the qdrant engine.
+TYPED_RETRIEVAL = os.getenv("TYPED_RETRIEVAL", "true").lower() == "true"
+RETRIEVAL_MAX_IMAGES = int(os.getenv("RETRIEVAL_MAX_IMAGES", "1"))
+RETRIEVAL_IMAGE_CANDIDATES = int(os.getenv("RETRIEVAL_IMAGE_CANDIDATES", "4"))
+
+# Every manual served by this backend, and the centroid index used to route questions to them.
+# Without a registry file the single manual above is served.
+manual_registry = ManualRegistry.load(
+    os.getenv("MANUAL_REGISTRY_PATH", os.path.join(os.path.dirname(__file__), "manuals.json")),
+    default_manual={"collection": QDRANT_COLLECTION_NAME, "document": document},
+    centroid_path=os.getenv(
+        "MANUAL_CENTROIDS_PATH", os.path.join(os.path.dirname(__file__), ".cache", "manual_centroids.npz")
+    ),
+)
+
+def _create_collection_retriever(collection_name):
+    bm25_index_path = os.path.join(BM25_INDEX_DIR, f"{collection_name}.npz")
+    use_hybrid = HYBRID_RETRIEVAL in ("true", "auto")
+    return create_retriever(
+        RETRIEVER_ENGINE,
+        qdrant_client,
+        collection_name,
+        local_index_dir=os.path.join(LOCAL_INDEX_DIR, collection_name),
+        use_int8=os.getenv("LOCAL_INDEX_INT8", "false").lower() == "true",
+        bm25_index_path=bm25_index_path if use_hybrid else None,
+        hybrid_candidates=int(os.getenv("HYBRID_CANDIDATES", "20")),
+        rrf_k=int(os.getenv("RRF_K", "60")),
+        bm25_reload_interval=float(os.getenv("BM25_RELOAD_SECONDS", "5")),
+        search_params=search_params(QDRANT_HNSW_EF, QDRANT_OVERSAMPLING, QDRANT_RESCORE),
+        with_payload=payload_selector(QDRANT_PAYLOAD_FIELDS),
+        max_images=RETRIEVAL_MAX_IMAGES if TYPED_RETRIEVAL else None,
+        image_candidates=RETRIEVAL_IMAGE_CANDIDATES,
+    )
+
+retriever = ManualRouter(
+    manual_registry,
+    _create_collection_retriever,
+    max_collections=int(os.getenv("ROUTER_MAX_COLLECTIONS", "3")),
+    rrf_k=int(os.getenv("RRF_K", "60")),
+)
+for _collection in manual_registry.collections:
+    retriever.retriever_for(_collection)
+
+# Query embeddings are cached in-process and on local disk so repeat questions skip the Azure call.
+# Set EMBEDDING_CACHE_PATH to an empty string to keep the cache in memory only.
+embedding_cache = EmbeddingCache(
+    path=os.getenv("EMBEDDING_CACHE_PATH", os.path.join(os.path.dirname(__file__), ".cache", "embeddings.sqlite3")),
+    max_memory_entries=int(os.getenv("EMBEDDING_CACHE_MEMORY_ENTRIES", "2048")),
+    max_disk_entries=int(os.getenv("EMBEDDING_CACHE_DISK_ENTRIES", "100000")),
+    ttl_seconds=float(os.getenv("EMBEDDING_CACHE_TTL_SECONDS", str(7 * 24 * 3600))),
+)
+
+# Final answers are reused for near-identical standalone questions that retrieved the same chunks
+# under the same case context. The cache is scoped to the collection version and cleared when it changes,
+# including when the alias is switched to a new version.
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_COLLECTION_CHECK_SECONDS = float(os.getenv("ANSWER_CACHE_COLLECTION_CHECK_SECONDS", "30"))
+answer_cache = SemanticAnswerCache(
+    similarity_threshold=float(os.getenv("ANSWER_CACHE_SIMILARITY_THRESHOLD", "0.95")),
+    max_buckets=int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1024")),
+    ttl_seconds=float(os.getenv("ANSWER_CACHE_TTL_SECONDS", str(24 * 3600))),
+)
+_collection_checked_at = 0.0
+
+# Manual context sent with the final prompt: total token budget (filled in retrieval order) and the
+# largest share a single chunk may take before it is windowed around the best-matching passage.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+CONTEXT_MAX_CHUNK_TOKENS = int(os.getenv("CONTEXT_MAX_CHUNK_TOKENS", "1200"))
+
+# Conversation history sent to the LLM: the last HISTORY_RECENT_TURNS turns verbatim, older turns folded
+# into a rolling summary, and never more than HISTORY_TOKEN_LIMIT tokens in total.
+HISTORY_RECENT_TURNS = int(os.getenv("HISTORY_RECENT_TURNS", "3"))
+HISTORY_TOKEN_LIMIT = int(os.getenv("HISTORY_TOKEN_LIMIT", "1500"))
+HISTORY_SUMMARY_MAX_TOKENS = int(os.getenv("HISTORY_SUMMARY_MAX_TOKENS", "300"))
+
+# "auto" skips the rewrite for questions that are already self-contained; "always" restores the
+# previous behaviour of rewriting whenever there is history or case context.
+REWRITE_POLICY = os.getenv("REWRITE_POLICY", "auto").lower()
+rewrite_memo = RewriteMemo(max_entries=int(os.getenv("REWRITE_MEMO_ENTRIES", "4096")))
+
+# While the rewrite call is in flight, embed and search on the raw question. The speculative hits are
+# reused when the rewritten question's embedding is close enough to the raw one that retrieval would
+# return (nearly) the same top-k; otherwise a second search is run.
+SPECULATIVE_RETRIEVAL = os.getenv("SPECULATIVE_RETRIEVAL", "true").lower() == "true"
+SPECULATIVE_REUSE_THRESHOLD = float(os.getenv("SPECULATIVE_REUSE_THRESHOLD", "0.9"))
+speculation_stats = {"hits": 0, "misses": 0}
+
+# Suggested questions come from the precomputed bank built by question_bank.py. Requests with use_llm,
+# and any made while no bank exists, fall back to generating them with the chat deployment.
+question_bank = QuestionBank(
+    qdrant_client,
+    candidate_factor=int(os.getenv("QUESTION_BANK_CANDIDATE_FACTOR", "4")),
+    diversity=float(os.getenv("QUESTION_BANK_DIVERSITY", "0.3")),
+    recheck_seconds=float(os.getenv("QUESTION_BANK_RECHECK_SECONDS", "300")),
+)
+
+# Batch answering: chat calls in flight per batch, and inputs per embeddings request.
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "8"))
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "256"))
+
+NO_CASE_DETAILS = "No case details provided."
+INVALID_RESPONSE_ANSWER = "The system generated an invalid response. Please try rephrasing your question."
+
+async def ask_rag(query: UserQuery) -> ApiResponse:
+    async with _request_slots:
+        return await _ask_rag(query)
+
+async def _ask_rag(query: UserQuery) -> ApiResponse:
+    case_context_str, standalone_question, speculative = await _resolve_question(query)
+    question_embedding, search_result = await _retrieve(standalone_question, query.top_k, speculative, query.manuals)
+
+    return await _answer(query, case_context_str, standalone_question, question_embedding, search_result)
+
+async def _answer(query, case_context_str, standalone_question, question_embedding, search_result):
+    cached = await _lookup_cached_answer(case_context_str, standalone_question, question_embedding, search_result)
+    if cached is not None:
+        return cached
+
+    with stage("context"):
+        context, rawSources = _prepare_context_and_raw_sources(search_result, standalone_question)
+    final_prompt = _build_final_prompt(query, case_context_str, context, await _compact_history(query))
+    raw_output = await _get_llm_response(final_prompt)
+    with stage("parse"):
+        response = _parse_and_validate_output(raw_output, standalone_question, rawSources)
+    _store_answer(case_context_str, question_embedding, search_result, response)
+    return response
+
+async def ask_rag_batch(queries: List[UserQuery]) -> List[BatchItemResult]:
+    async with _request_slots:
+        return await _ask_rag_batch(queries)
+
+async def _ask_rag_batch(queries: List[UserQuery]) -> List[BatchItemResult]:
+    """
+    Answers many questions at once: rewrites run concurrently, all standalone questions are embedded
+    in one embeddings request, Qdrant is queried with a single search_batch, and the final chat
+    calls run with at most BATCH_MAX_CONCURRENCY in flight. Results come back in input order and a
+    failure only affects its own item. Every stage goes through the same caches as ask_rag, so a
+    batch run also warms them.
+    """
+    results = [BatchItemResult(index=i) for i in range(len(queries))]
+    slots = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
+
+    async def resolve(query):
+        manual_registry.validate(query.manuals)
+        async with slots:
+            case_context_str = _format_case_context(query.case_context)
+            return case_context_str, await _get_standalone_question(query, case_context_str)
+
+    resolved = await asyncio.gather(*(resolve(q) for q in queries), return_exceptions=True)
+    pending = []
+    for i, outcome in enumerate(resolved):
+        if isinstance(outcome, BaseException):
+            results[i].error = _describe_error(outcome)
+        else:
+            pending.append(i)
+    if not pending:
+        return results
+
+    try:
+        standalone_questions = [resolved[i][1] for i in pending]
+        embeddings = await _get_question_embeddings(standalone_questions)
+        search_results = await _search_qdrant_batch(
+            embeddings, [queries[i].top_k for i in pending], standalone_questions, [queries[i].manuals for i in pending]
+        )
+    except Exception as e:
+        for i in pending:
+            results[i].error = _describe_error(e)
+        return results
+
+    async def answer(i, question_embedding, search_result):
+        async with slots:
+            case_context_str, standalone_question = resolved[i]
+            return await _answer(queries[i], case_context_str, standalone_question, question_embedding, search_result)
+
+    answers = await asyncio.gather(
+        *(answer(i, e, r) for i, e, r in zip(pending, embeddings, search_results)),
+        return_exceptions=True,
+    )
+    for i, outcome in zip(pending, answers):
+        if isinstance(outcome, BaseException):
+            results[i].error = _describe_error(outcome)
+        else:
+            results[i].response = outcome
+    print(f"LOG: Batch of {len(queries)} questions finished, {sum(1 for r in results if r.error)} failed.")
+    return results
+
+def _describe_error(error):
+    return f"{type(error).__name__}: {error}"
+
+async def ask_rag_stream(query: UserQuery):
+    """
+    Streaming variant of ask_rag. Yields (event, data) pairs in order: the standalone question,
+    the retrieved sections, the answer text token by token, and finally the validated sources.
+    """
+    async with _request_slots:
+        case_context_str, standalone_question, speculative = await _resolve_question(query)
+        try:
+            yield "question", {"question": standalone_question}
+            question_embedding, search_result = await _retrieve(
+                standalone_question, query.top_k, speculative, query.manuals
+            )
+        finally:
+            # A client that disconnects after the first event closes the generator before _retrieve
+            # has awaited the speculative task; don't leave it running or its exception unretrieved.
+            _discard_speculative(speculative)
+        with stage("context"):
+            context, rawSources = _prepare_context_and_raw_sources(search_result, standalone_question)
+        yield "sources", [rs.model_dump(exclude={"chunk"}) for rs in rawSources]
+
+        response = await _lookup_cached_answer(case_context_str, standalone_question, question_embedding, search_result)
+        if response is not None:
+            yield "token", {"text": response.answer}
+        else:
+            final_prompt = _build_final_prompt(query, case_context_str, context, await _compact_history(query))
+            answer_streamer = JsonStringFieldStreamer("answer")
+            raw_parts = []
+            async for delta in _stream_llm_response(final_prompt):
+                raw_parts.append(delta)
+                text = answer_streamer.feed(delta)
+                if text:
+                    yield "token", {"text": text}
+            raw_output = "".join(raw_parts).strip()
+            # Streamed responses carry no usage block, so the token counts are measured locally.
+            record_tokens("completion", count_tokens(SYSTEM_PROMPT) + count_tokens(final_prompt), count_tokens(raw_output))
+            with stage("parse"):
+                response = _parse_and_validate_output(raw_output, standalone_question, rawSources)
+            _store_answer(case_context_str, question_embedding, search_result, response)
+
+        yield "validated_sources", {
+            "answer": response.answer,
+            "validated_sources": [vs.model_dump() for vs in response.validated_sources],
+        }
+
+async def _resolve_question(query):
+    """
+    Returns the case context string, the standalone question and, when a rewrite call had to be
+    made, the speculative retrieval task that ran on the raw question in the meantime.
+    """
+    manual_registry.validate(query.manuals)
     case_context_str = _format_case_context(query.case_context)
-    standalone_question = _get_standalone_question(query, case_context_str)
+    speculative = None
+    if SPECULATIVE_RETRIEVAL and _rewrite_pending(query, case_context_str):
+        speculative = asyncio.create_task(_retrieve(query.question, query.top_k, manuals=query.manuals))
+    try:
+        standalone_question = await _get_standalone_question(query, case_context_str)
+    except BaseException:
+        if speculative is not None:
+            speculative.cancel()
+        raise
     print(f"Original Question: '{query.question}'")
     print(f"Case Context: {case_context_str}")
     print(f"Standalone Question for Search: '{standalone_question}'")
+    return case_context_str, standalone_question, speculative
 
-    question_embedding = _get_question_embedding(standalone_question)
-    search_result = _search_qdrant(question_embedding, query.top_k)
-    context, rawSources = _prepare_context_and_raw_sources(search_result)
-    final_prompt = _build_final_prompt(query, case_context_str, context)
-    raw_output = _get_llm_response(final_prompt)
-    return _parse_and_validate_output(raw_output, standalone_question, rawSources)
-
-def _get_standalone_question(query, case_context_str):
-    if getattr(query, "history", None) or case_context_str.strip():
-        chat_history_str = "\n".join([f"{msg.role}: {msg.content}" for msg in getattr(query, "history", [])])
-        rewrite_prompt = REWRITE_PROMPT.format(
-            chat_history=chat_history_str,
-            case_context=case_context_str,
-            question=query.question
-        )
-        response = client.chat.completions.create(
-            model=os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT"),
+def _discard_speculative(speculative):
+    if speculative is None:
+        return
+    if not speculative.done():
+        speculative.cancel()
+    elif not speculative.cancelled():
+        speculative.exception()
+
+async def _retrieve(standalone_question, top_k, speculative=None, manuals=None):
+    if speculative is not None:
+        try:
+            speculative_embedding, speculative_result = await speculative
+        except Exception as e:
+            print(f"WARN: Speculative retrieval failed, searching again: {e}")
+        else:
+            question_embedding = await _get_question_embedding(standalone_question)
+            if _cosine(question_embedding, speculative_embedding) >= SPECULATIVE_REUSE_THRESHOLD:
+                _record_speculation(hit=True)
+                return question_embedding, speculative_result
+            _record_speculation(hit=False)
+            return question_embedding, await _search_qdrant(question_embedding, top_k, standalone_question, manuals)
+
+    question_embedding = await _get_question_embedding(standalone_question)
+    search_result = await _search_qdrant(question_embedding, top_k, standalone_question, manuals)
+    return question_embedding, search_result
+
+def _record_speculation(hit):
+    record_cache("speculative_retrieval", hit)
+    speculation_stats["hits" if hit else "misses"] += 1
+    total = speculation_stats["hits"] + speculation_stats["misses"]
+    print(f"LOG: Speculative retrieval {'hit' if hit else 'miss'} (hit rate {speculation_stats['hits'] / total:.0%} over {total}).")
+
+def _cosine(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+async def _lookup_cached_answer(case_context_str, standalone_question, question_embedding, search_result):
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    await _refresh_answer_cache_namespace()
+    cached = answer_cache.lookup(case_context_str, section_fingerprint(search_result), question_embedding)
+    record_cache("answer", cached is not None)
+    if cached is not None:
+        print("LOG: Semantic answer cache hit, skipping the chat completion.")
+        cached.question = standalone_question
+    return cached
+
+def _store_answer(case_context_str, question_embedding, search_result, response):
+    if ANSWER_CACHE_ENABLED and response.answer != INVALID_RESPONSE_ANSWER:
+        answer_cache.store(case_context_str, section_fingerprint(search_result), question_embedding, response)
+
+async def _refresh_answer_cache_namespace():
+    """Re-reads the collection state at most every ANSWER_CACHE_COLLECTION_CHECK_SECONDS."""
+    global _collection_checked_at
+    now = time.monotonic()
+    if now - _collection_checked_at < ANSWER_CACHE_COLLECTION_CHECK_SECONDS:
+        return
+    _collection_checked_at = now
+    try:
+        namespace = await retriever.fingerprint()
+    except Exception as e:
+        print(f"WARN: Could not read collection info for the answer cache: {e}")
+        return
+    answer_cache.use_namespace(namespace)
+
+def _needs_rewrite(query, case_context_str):
+    history = getattr(query, "history", None) or []
+    if REWRITE_POLICY == "always":
+        return bool(history) or bool(case_context_str.strip())
+    return (bool(history) or _has_case_context(case_context_str)) and not is_self_contained(query.question)
+
+def _has_case_context(case_context_str):
+    return bool(case_context_str.strip()) and case_context_str != NO_CASE_DETAILS
+
+def _rewrite_memo_key(query, case_context_str):
+    return rewrite_key(format_messages(getattr(query, "history", [])), case_context_str, query.question)
+
+def _rewrite_pending(query, case_context_str):
+    """True when resolving the standalone question will cost a chat completion."""
+    return _needs_rewrite(query, case_context_str) and rewrite_memo.get(_rewrite_memo_key(query, case_context_str)) is None
+
+async def _get_standalone_question(query, case_context_str):
+    if not _needs_rewrite(query, case_context_str):
+        return query.question
+
+    memo_key = _rewrite_memo_key(query, case_context_str)
+    cached = rewrite_memo.get(memo_key)
+    record_cache("rewrite", cached is not None)
+    if cached is not None:
+        return cached
+
+    rewrite_prompt = REWRITE_PROMPT.format(
+        chat_history=await _compact_history(query),
+        case_context=case_context_str,
+        question=query.question
+    )
+    with stage("rewrite"):
+        response = await _create_chat_completion(
+            "rewrite",
+            model=_rewrite_deployment(),
             messages=[{"role": "user", "content": rewrite_prompt}],
             temperature=0.0,
             max_tokens=100
         )
-        return response.choices[0].message.content.strip()
-    return query.question
-
-def _get_question_embedding(question):
-    return client.embeddings.create(
-        input=[question],
-        model=os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT")
-    ).data[0].embedding
-
-def _search_qdrant(question_embedding, top_k):
-    return qdrant_client.search(
-        collection_name=QDRANT_COLLECTION_NAME,
-        query_vector=question_embedding,
-        limit=top_k,
-        with_payload=True
+    record_usage("rewrite", response)
+    standalone_question = response.choices[0].message.content.strip()
+    rewrite_memo.put(memo_key, standalone_question)
+    return standalone_question
+
+async def _compact_history(query):
+    return await history_compactor.compact(getattr(query, "history", None))
+
+async def _summarize_history(previous_summary, messages):
+    prompt = HISTORY_SUMMARY_PROMPT.format(
+        max_words=HISTORY_SUMMARY_MAX_TOKENS * 3 // 4,
+        previous_summary=previous_summary or "(none yet)",
+        new_messages=format_messages(messages),
+    )
+    with stage("history_summary"):
+        response = await _create_chat_completion(
+            "history_summary",
+            model=_rewrite_deployment(),
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0.0,
+            max_tokens=HISTORY_SUMMARY_MAX_TOKENS
+        )
+    record_usage("history_summary", response)
+    return response.choices[0].message.content
+
+history_compactor = HistoryCompactor(
+    _summarize_history,
+    recent_turns=HISTORY_RECENT_TURNS,
+    token_limit=HISTORY_TOKEN_LIMIT,
+    summary_tokens=HISTORY_SUMMARY_MAX_TOKENS,
+    max_entries=int(os.getenv("HISTORY_SUMMARY_ENTRIES", "4096")),
+)
+
+async def _create_chat_completion(stage_name, **kwargs):
+    """ Chat completion with the stage's timeout and the shared retry policy. """
+    staged_client = client.with_options(timeout=STAGE_TIMEOUTS[stage_name])
+    return await _with_retry(stage_name, lambda: staged_client.chat.completions.create(**kwargs))
+
+async def _create_embeddings(**kwargs):
+    staged_client = client.with_options(timeout=STAGE_TIMEOUTS["embedding"])
+    return await _with_retry("embedding", lambda: staged_client.embeddings.create(**kwargs))
+
+async def _with_retry(stage_name, make_call):
+    return await call_with_retry(
+        stage_name,
+        make_call,
+        max_attempts=AZURE_OPENAI_MAX_ATTEMPTS,
+        base_delay=AZURE_OPENAI_RETRY_BASE_DELAY,
+        max_delay=AZURE_OPENAI_RETRY_MAX_DELAY,
     )
 
-def _prepare_context_and_raw_sources(search_result):
+def _rewrite_deployment():
+    """Rewrites are short and latency-bound, so they may use a faster deployment than answers."""
+    return os.getenv("AZURE_OPENAI_REWRITE_DEPLOYMENT") or os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT")
+
+async def _get_question_embedding(question):
+    deployment = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT")
+    cached = await embedding_cache.get(deployment, question)
+    record_cache("embedding", cached is not None)
+    if cached is not None:
+        return cached
+
+    with stage("embedding"):
+        response = await _create_embeddings(
+            input=[question],
+            model=deployment
+        )
+    record_usage("embedding", response)
+    embedding = response.data[0].embedding
+    await embedding_cache.put(deployment, question, embedding)
+    return embedding
+
+async def _get_question_embeddings(questions):
+    """Embeds many questions with a single request per EMBEDDING_BATCH_SIZE cache misses."""
+    deployment = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT")
+    embeddings = await embedding_cache.get_many(deployment, questions)
+    for e in embeddings:
+        record_cache("embedding", e is not None)
+    missing = list(dict.fromkeys(q for q, e in zip(questions, embeddings) if e is None))
+    fetched = {}
+    for start in range(0, len(missing), EMBEDDING_BATCH_SIZE):
+        batch = missing[start:start + EMBEDDING_BATCH_SIZE]
+        with stage("embedding"):
+            response = await _create_embeddings(input=batch, model=deployment)
+        record_usage("embedding", response)
+        for item in response.data:
+            fetched[batch[item.index]] = item.embedding
+            await embedding_cache.put(deployment, batch[item.index], item.embedding)
+    return [e if e is not None else fetched[q] for q, e in zip(questions, embeddings)]
+
+async def _search_qdrant_batch(question_embeddings, top_ks, questions=None, manuals_per_query=None):
+    with stage("retrieval"):
+        return await retriever.search_batch(question_embeddings, top_ks, questions, manuals_per_query)
+
+async def _search_qdrant(question_embedding, top_k, question=None, manuals=None):
+    with stage("retrieval"):
+        return await retriever.search(question_embedding, top_k, question, manuals)
+
+def _prepare_context_and_raw_sources(search_result, question):
     context = ""
     rawSources = []
-    for r in search_result:
+    for r, text in pack_context(search_result, question, CONTEXT_TOKEN_BUDGET, CONTEXT_MAX_CHUNK_TOKENS):
         p = r.payload
         similarity = float(r.score)
         context += (
             f"Source (Section {p.get('section_number','N/A')}, Title: {p.get('section_title','')}, "
-            f"Score: {similarity:.4f}):\n{p.get('content','')}\n\n"
+            f"Score: {similarity:.4f}):\n{text}\n\n"
         )
         rawSources.append(RawSource(            
-            document=document,
+            document=manual_registry.document_for(p.get("collection")),
             section_number=p.get("section_number", "N/A"),
             section_title=p.get("section_title", "N/A"),
             page_number=p.get("page_number", -1),
@@ -98,8 +587,7 @@ def _prepare_context_and_raw_sources(search_result):
         ))
     return context, rawSources
 
-def _build_final_prompt(query, case_context_str, context):
-    conversation_history_for_prompt = "\n".join([f"{msg.role}: {msg.content}" for msg in getattr(query, "history", [])])
+def _build_final_prompt(query, case_context_str, context, conversation_history_for_prompt):
     return (
         f"CONVERSATION HISTORY:\n---\n{conversation_history_for_prompt}\n---\n\n"
         f"CURRENT CASE CONTEXT:\n---\n{case_context_str}\n---\n\n"
@@ -109,17 +597,42 @@ def _build_final_prompt(query, case_context_str, context):
         "please answer the user's latest question and provide the response in the required JSON format."
     )
 
-def _get_llm_response(final_prompt):
-    response = client.chat.completions.create(
+async def _get_llm_response(final_prompt):
+    with stage("completion"):
+        response = await _create_chat_completion(
+            "completion",
+            model=os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT"),
+            messages=[
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": final_prompt}
+            ],
+            temperature=0.0,
+            response_format={"type": "json_object"}
+        )
+    record_usage("completion", response)
+    return response.choices[0].message.content.strip()
+
+async def _stream_llm_response(final_prompt):
+    started = time.perf_counter()
+    first_token_at = None
+    stream = await _create_chat_completion(
+        "completion",
         model=os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT"),
         messages=[
             {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": final_prompt}
         ],
         temperature=0.0,
-        response_format={"type": "json_object"}
+        response_format={"type": "json_object"},
+        stream=True
     )
-    return response.choices[0].message.content.strip()
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+                observe_stage("completion_first_token", first_token_at - started)
+            yield chunk.choices[0].delta.content
+    observe_stage("completion", time.perf_counter() - started)
 
 def _parse_and_validate_output(raw_output, standalone_question, rawSources):
     try:
@@ -127,7 +640,7 @@ def _parse_and_validate_output(raw_output, standalone_question, rawSources):
     except json.JSONDecodeError:
         return ApiResponse(
             question=standalone_question,
-            answer="The system generated an invalid response. Please try rephrasing your question.",
+            answer=INVALID_RESPONSE_ANSWER,
             validated_sources=[],
             raw_sources=[rs.dict() for rs in rawSources]
         )
@@ -172,14 +685,24 @@ def _parse_and_validate_output(raw_output, standalone_question, rawSources):
         # raw_sources=rawSources,
     )
 
-def suggest_questions(request: SuggestQuestionsRequest) -> SuggestQuestionsResponse:
+async def suggest_questions(request: SuggestQuestionsRequest) -> SuggestQuestionsResponse:
+    async with _request_slots:
+        return await _suggest_questions(request)
+
+async def _suggest_questions(request: SuggestQuestionsRequest) -> SuggestQuestionsResponse:
     case_context_str = _format_case_context(request.case_context)
-    standalone_question = _rewrite_suggestion_question(case_context_str)
+    # Without case details there is nothing to match the bank against; embedding the placeholder
+    # would pick questions near "No case details provided.".
+    if not request.use_llm and _has_case_context(case_context_str):
+        response = await _suggest_from_question_bank(case_context_str, request.top_k)
+        if response is not None:
+            return response
+    standalone_question = await _rewrite_suggestion_question(case_context_str)
     print(f"Case Context: {case_context_str}")
     print(f"Standalone Question for Search: '{standalone_question}'")
 
-    question_embedding = _get_question_embedding(standalone_question)
-    search_result = _search_qdrant(question_embedding, request.top_k)
+    question_embedding = await _get_question_embedding(standalone_question)
+    search_result = await _search_qdrant(question_embedding, request.top_k, standalone_question)
     # build manual_content and rawSources for the response
     manual_content = _build_manual_content(search_result)
     suggestion_raw_sources = []
@@ -187,7 +710,7 @@ def suggest_questions(request: SuggestQuestionsRequest) -> SuggestQuestionsRespo
         p = r.payload
         similarity = float(r.score)
         suggestion_raw_sources.append(RawSource(          
-            document=document,
+            document=manual_registry.document_for(p.get("collection")),
             section_number=p.get("section_number", "N/A"),
             section_title=p.get("section_title", "N/A"),
             page_number=p.get("page_number", -1),
@@ -199,7 +722,7 @@ def suggest_questions(request: SuggestQuestionsRequest) -> SuggestQuestionsRespo
         manual_content=manual_content,
         top_k=request.top_k
     )
-    raw_output = _get_suggest_questions_llm_response(prompt)
+    raw_output = await _get_suggest_questions_llm_response(prompt)
     questions = _parse_suggested_questions(raw_output)
     return SuggestQuestionsResponse(
         question=standalone_question,
@@ -207,18 +730,55 @@ def suggest_questions(request: SuggestQuestionsRequest) -> SuggestQuestionsRespo
         # raw_sources=suggestion_raw_sources,
     )
 
-def _rewrite_suggestion_question(case_context_str):
+async def _suggest_from_question_bank(case_context_str, top_k):
+    """ Embeds the case context once and picks diverse questions from the bank; None when there is no bank. """
+    try:
+        has_bank = bool(await question_bank.available(manual_registry.collections))
+    except Exception as e:
+        print(f"WARN: Question bank unavailable, generating suggestions with the LLM: {e}")
+        return None
+    if not has_bank:
+        return None
+    embedding = await _get_question_embedding(case_context_str)
+    collections = manual_registry.route(embedding, max_collections=retriever.max_collections)
+    try:
+        with stage("question_bank"):
+            picked = await question_bank.suggest(embedding, collections, top_k)
+    except Exception as e:
+        print(f"WARN: Question bank unavailable, generating suggestions with the LLM: {e}")
+        return None
+    if not picked:
+        print("WARN: Question bank is empty, generating suggestions with the LLM.")
+        return None
+    return SuggestQuestionsResponse(
+        # The bank is searched with the case context itself; no standalone question was written.
+        question="",
+        suggested_questions=[p["question"] for p in picked],
+    )
+
+async def _rewrite_suggestion_question(case_context_str):
     if case_context_str.strip():
+        memo_key = rewrite_key("suggest-questions", case_context_str, "")
+        cached = rewrite_memo.get(memo_key)
+        record_cache("rewrite", cached is not None)
+        if cached is not None:
+            return cached
+
         rewrite_prompt = REWRITE_SUGGESTION_QUESTION_PROMPT.format(
             formatted_case_context=case_context_str
         )
-        response = client.chat.completions.create(
-            model=os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT"),
-            messages=[{"role": "user", "content": rewrite_prompt}],
-            temperature=0.0,
-            max_tokens=100
-        )
-        return response.choices[0].message.content.strip()
+        with stage("rewrite"):
+            response = await _create_chat_completion(
+                "rewrite",
+                model=_rewrite_deployment(),
+                messages=[{"role": "user", "content": rewrite_prompt}],
+                temperature=0.0,
+                max_tokens=100
+            )
+        record_usage("rewrite", response)
+        standalone_question = response.choices[0].message.content.strip()
+        rewrite_memo.put(memo_key, standalone_question)
+        return standalone_question
     return ""
 
 def _build_manual_content(search_result):
@@ -227,29 +787,25 @@ def _build_manual_content(search_result):
         for r in search_result
     ])
 
-def _get_suggest_questions_llm_response(prompt):
-    response = client.chat.completions.create(
-        model=os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT"),
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.3,
-        max_tokens=200
-    )
+async def _get_suggest_questions_llm_response(prompt):
+    with stage("suggest_completion"):
+        response = await _create_chat_completion(
+            "suggest_completion",
+            model=os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT"),
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0.3,
+            max_tokens=200
+        )
+    record_usage("suggest_completion", response)
     return response.choices[0].message.content.strip()
 
 def _parse_suggested_questions(raw_output):
-    questions = []
-    for line in raw_output.split('\n'):
-        line = line.strip()
-        if line and (line[0].isdigit() or line.startswith('-')):
-            q = line.split('.', 1)[-1].strip() if '.' in line else line.lstrip('-').strip()
-            if q:
-                questions.append(q)
-    return questions
+    return parse_numbered_questions(raw_output)
 
 def _format_case_context(case_context) -> str:
     """Helper function to format the case context object into a string."""
     if not case_context:
-        return "No case details provided."
+        return NO_CASE_DETAILS
 
     context_parts = []
     if getattr(case_context, "case_type", None):
@@ -260,4 +816,4 @@ def _format_case_context(case_context) -> str:
         entities_str = ", ".join(case_context.involved_entities)
         context_parts.append(f"- Involved Entities: {entities_str}")
 
-    return "\n".join(context_parts) if context_parts else "No case details provided."
\ No newline at end of file
+    return "\n".join(context_parts) if context_parts else NO_CASE_DETAILS
\ No newline at end of file
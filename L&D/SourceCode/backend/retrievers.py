@@ -0,0 +1,320 @@
+"""retrievers.py
+
+Retrieval engines behind rag_utils._search_qdrant.
+
+Every retriever exposes the same async interface and returns Qdrant ScoredPoint objects, so the rest
+of the pipeline does not care which engine produced the hits:
+
+    search(embedding, top_k, query_text)                -> List[ScoredPoint]
+    search_batch(embeddings, top_ks, query_texts)       -> List[List[ScoredPoint]]
+    retrieve_scored(ids, embedding)                     -> List[ScoredPoint] for known point ids
+    fingerprint()                                       -> str identifying the current contents
+
+Dense engines ignore query_text; HybridRetriever uses it for the BM25 side. TypedRetriever searches
+section text and image captions separately and attaches image hits to their sections.
+"""
+import asyncio
+import os
+import time
+from typing import List
+
+import numpy as np
+from qdrant_client import models as qdrant_models
+
+from bm25_index import BM25Index, reciprocal_rank_fusion
+from collection_profiles import type_filter
+from local_index import LocalVectorIndex
+
+# Chunk types produced by the chunker for image captions.
+IMAGE_CHUNK_TYPES = ("image",)
+
+
+class QdrantRetriever:
+    """
+    Searches a collection on a Qdrant server. `search_params` carries hnsw_ef and quantization
+    oversampling/rescoring; `with_payload` is normally a projection onto the fields the backend uses.
+    `chunk_types` / `exclude_chunk_types` restrict hits on the indexed `type` payload field.
+    """
+
+    def __init__(self, client, collection_name: str, search_params=None, with_payload=True,
+                 chunk_types=None, exclude_chunk_types=None):
+        self.client = client
+        self.collection_name = collection_name
+        self.search_params = search_params
+        self.with_payload = with_payload
+        self.chunk_types = chunk_types
+        self.exclude_chunk_types = exclude_chunk_types
+        self.query_filter = type_filter(chunk_types, exclude_chunk_types)
+
+    async def search(self, embedding, top_k: int, query_text: str = None):
+        return await self.client.search(
+            collection_name=self.collection_name,
+            query_vector=embedding,
+            query_filter=self.query_filter,
+            limit=top_k,
+            search_params=self.search_params,
+            with_payload=self.with_payload
+        )
+
+    async def search_batch(self, embeddings, top_ks, query_texts=None):
+        return await self.client.search_batch(
+            collection_name=self.collection_name,
+            requests=[
+                qdrant_models.SearchRequest(
+                    vector=embedding, filter=self.query_filter, limit=top_k, params=self.search_params,
+                    with_payload=self.with_payload,
+                )
+                for embedding, top_k in zip(embeddings, top_ks)
+            ],
+        )
+
+    async def retrieve_scored(self, ids, embedding):
+        records = await self.client.retrieve(
+            collection_name=self.collection_name, ids=ids, with_payload=self.with_payload, with_vectors=True
+        )
+        query = _unit(embedding)
+        return [
+            qdrant_models.ScoredPoint(
+                id=r.id, version=0, score=float(_unit(r.vector) @ query), payload=r.payload
+            )
+            for r in records
+            if self._type_allowed(r.payload)
+        ]
+
+    def _type_allowed(self, payload) -> bool:
+        chunk_type = (payload or {}).get("type")
+        if self.chunk_types and chunk_type not in self.chunk_types:
+            return False
+        return not (self.exclude_chunk_types and chunk_type in self.exclude_chunk_types)
+
+    async def fingerprint(self) -> str:
+        info = await self.client.get_collection(self.collection_name)
+        # When the name is an alias, include the version it points to so a switch changes the fingerprint.
+        aliases = (await self.client.get_aliases()).aliases
+        target = next((a.collection_name for a in aliases if a.alias_name == self.collection_name), self.collection_name)
+        return f"{target}:{info.points_count}"
+
+
+class LocalRetriever:
+    """Searches an in-process LocalVectorIndex; no network hop and sub-millisecond for one manual."""
+
+    def __init__(self, index_dir: str, use_int8: bool = False):
+        self.index_dir = index_dir
+        self.index = LocalVectorIndex(index_dir, use_int8=use_int8)
+        print(f"Loaded local vector index '{index_dir}' with {len(self.index)} points.")
+
+    async def search(self, embedding, top_k: int, query_text: str = None):
+        return self._search(embedding, top_k)
+
+    async def search_batch(self, embeddings, top_ks, query_texts=None):
+        return [self._search(embedding, top_k) for embedding, top_k in zip(embeddings, top_ks)]
+
+    async def retrieve_scored(self, ids, embedding):
+        query = _unit(embedding)
+        rows = [row for row in (self.index.row_of(point_id) for point_id in ids) if row is not None]
+        return [
+            qdrant_models.ScoredPoint(
+                id=self.index.ids[row], version=0, score=float(self.index.vectors[row] @ query),
+                payload=self.index.payload(row),
+            )
+            for row in rows
+        ]
+
+    async def fingerprint(self) -> str:
+        meta = self.index.meta
+        return f"{meta['collection']}:{meta['count']}:{meta['built_at']}"
+
+    def _search(self, embedding, top_k: int) -> List[qdrant_models.ScoredPoint]:
+        return [
+            qdrant_models.ScoredPoint(
+                id=self.index.ids[row], version=0, score=score, payload=self.index.payload(row)
+            )
+            for row, score in self.index.search(embedding, top_k)
+        ]
+
+
+class HybridRetriever:
+    """
+    Runs a dense retriever and a BM25 index side by side and fuses the two rankings with
+    reciprocal-rank fusion. Hits found only lexically are fetched from the dense engine so that
+    every result still carries its payload and true cosine similarity.
+
+    Publishing a collection version replaces the index file; searches notice the new modification
+    time within `reload_interval` seconds and load it. Until the file first appears (a collection
+    that has not been published yet) searches are dense only.
+    """
+
+    def __init__(self, dense, bm25_index_path: str, candidates: int = 20, rrf_k: int = 60,
+                 reload_interval: float = 5.0):
+        self.dense = dense
+        self.bm25_index_path = bm25_index_path
+        self._checked_at = time.monotonic()
+        self.index = None
+        self._index_mtime = None
+        self.candidates = candidates
+        self.rrf_k = rrf_k
+        self.reload_interval = reload_interval
+        self._reload_if_stale(force=True)
+        if self.index is None:
+            print(f"No BM25 index at '{bm25_index_path}' yet; searching dense only until it is published.")
+
+    async def search(self, embedding, top_k: int, query_text: str = None):
+        self._reload_if_stale()
+        dense_hits = await self.dense.search(embedding, max(top_k, self.candidates))
+        return await self._fuse(embedding, top_k, query_text, dense_hits)
+
+    async def search_batch(self, embeddings, top_ks, query_texts=None):
+        query_texts = query_texts or [None] * len(embeddings)
+        self._reload_if_stale()
+        dense_batches = await self.dense.search_batch(embeddings, [max(k, self.candidates) for k in top_ks])
+        return await asyncio.gather(*(
+            self._fuse(embedding, top_k, text, hits)
+            for embedding, top_k, text, hits in zip(embeddings, top_ks, query_texts, dense_batches)
+        ))
+
+    async def retrieve_scored(self, ids, embedding):
+        return await self.dense.retrieve_scored(ids, embedding)
+
+    async def fingerprint(self) -> str:
+        self._reload_if_stale(force=True)
+        return f"{await self.dense.fingerprint()}:bm25:{self._index_mtime}"
+
+    def _reload_if_stale(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.reload_interval:
+            return
+        self._checked_at = now
+        if not os.path.exists(self.bm25_index_path):
+            return
+        try:
+            mtime = os.path.getmtime(self.bm25_index_path)
+            if mtime == self._index_mtime:
+                return
+            # A new collection version was published with its own index file.
+            index = BM25Index.load(self.bm25_index_path)
+        except Exception as e:
+            print(f"WARN: Could not load BM25 index '{self.bm25_index_path}', keeping the current one: {e}")
+            return
+        self.index, self._index_mtime = index, mtime
+        print(f"Loaded BM25 index '{self.bm25_index_path}' with {len(self.index.ids)} chunks.")
+
+    async def _fuse(self, embedding, top_k, query_text, dense_hits):
+        if not query_text or self.index is None:
+            return dense_hits[:top_k]
+        lexical_hits = self.index.search(query_text, max(top_k, self.candidates))
+        fused = reciprocal_rank_fusion(
+            [[hit.id for hit in dense_hits], [point_id for point_id, _score in lexical_hits]], self.rrf_k
+        )
+
+        by_id = {hit.id: hit for hit in dense_hits}
+        # Lexical-only hits are fetched in one call. An id the dense engine cannot resolve (a point
+        # deleted since the index was built) is dropped before the cut, so it does not cost a slot.
+        missing = [point_id for point_id, _score in fused if point_id not in by_id]
+        if missing:
+            by_id.update({hit.id: hit for hit in await self.dense.retrieve_scored(missing, embedding)})
+        return [by_id[point_id] for point_id, _score in fused if point_id in by_id][:top_k]
+
+
+class TypedRetriever:
+    """
+    Searches section text and image captions with separate type-filtered searches. Sections fill the
+    top_k; an image hit is attached to the retrieved section it belongs to (payload "images") instead
+    of taking a slot, and at most `max_images` images are used per query. An image whose section was
+    not retrieved only takes the last slot when it outscores the section there.
+    """
+
+    def __init__(self, sections, images, max_images: int = 1, image_candidates: int = 4):
+        self.sections = sections
+        self.images = images
+        self.max_images = max_images
+        self.image_candidates = image_candidates
+
+    async def search(self, embedding, top_k: int, query_text: str = None):
+        if self.max_images <= 0:
+            return await self.sections.search(embedding, top_k, query_text)
+        section_hits, image_hits = await asyncio.gather(
+            self.sections.search(embedding, top_k, query_text),
+            self.images.search(embedding, self.image_candidates),
+        )
+        return attach_images(section_hits, image_hits, top_k, self.max_images)
+
+    async def search_batch(self, embeddings, top_ks, query_texts=None):
+        if self.max_images <= 0:
+            return await self.sections.search_batch(embeddings, top_ks, query_texts)
+        section_batches, image_batches = await asyncio.gather(
+            self.sections.search_batch(embeddings, top_ks, query_texts),
+            self.images.search_batch(embeddings, [self.image_candidates] * len(embeddings)),
+        )
+        return [
+            attach_images(section_hits, image_hits, top_k, self.max_images)
+            for section_hits, image_hits, top_k in zip(section_batches, image_batches, top_ks)
+        ]
+
+    async def retrieve_scored(self, ids, embedding):
+        section_hits, image_hits = await asyncio.gather(
+            self.sections.retrieve_scored(ids, embedding), self.images.retrieve_scored(ids, embedding)
+        )
+        return section_hits + image_hits
+
+    async def fingerprint(self) -> str:
+        return await self.sections.fingerprint()
+
+
+def attach_images(section_hits, image_hits, top_k: int, max_images: int):
+    """Merges image hits into section hits as described on TypedRetriever; sections keep their order."""
+    hits = list(section_hits[:top_k])
+    by_section = {(hit.payload or {}).get("section_number"): hit for hit in hits}
+    used = 0
+    for image in sorted(image_hits, key=lambda hit: -hit.score):
+        if used >= max_images:
+            break
+        payload = image.payload or {}
+        # A deduplicated caption belongs to every section it appears in (see ingest chunk_dedupe.py).
+        sections = [ref.get("section_number") for ref in payload.get("occurrences") or [payload]]
+        parent = next((by_section[s] for s in sections if s and s in by_section), None)
+        if parent is not None:
+            figure = {"content": payload.get("content", ""), "page_number": payload.get("page_number"), "score": image.score}
+            parent.payload = {**parent.payload, "images": [*parent.payload.get("images", []), figure]}
+        elif len(hits) < top_k:
+            hits.append(image)
+        elif hits and image.score > hits[-1].score:
+            displaced = hits.pop()
+            by_section.pop((displaced.payload or {}).get("section_number"), None)
+            used -= len((displaced.payload or {}).get("images", []))
+            hits.append(image)
+        else:
+            continue
+        used += 1
+    return hits
+
+
+def _unit(vector) -> np.ndarray:
+    array = np.asarray(vector, dtype=np.float32)
+    return array / (np.linalg.norm(array) or 1.0)
+
+
+def create_retriever(engine: str, qdrant_client, collection_name: str, local_index_dir: str, use_int8: bool = False,
+                     bm25_index_path: str = None, hybrid_candidates: int = 20, rrf_k: int = 60,
+                     bm25_reload_interval: float = 5.0, search_params=None, with_payload=True, max_images: int = None, image_candidates: int = 4):
+    """`max_images` switches on type-aware retrieval (Qdrant engine only); None searches all chunks alike."""
+    typed = engine == "qdrant" and max_images is not None
+    if engine == "qdrant":
+        retriever = QdrantRetriever(
+            qdrant_client, collection_name, search_params=search_params, with_payload=with_payload,
+            exclude_chunk_types=IMAGE_CHUNK_TYPES if typed else None,
+        )
+    elif engine == "local":
+        retriever = LocalRetriever(local_index_dir, use_int8=use_int8)
+    else:
+        raise ValueError(f"Unknown RETRIEVER_ENGINE '{engine}'. Expected 'qdrant' or 'local'.")
+    if bm25_index_path:
+        retriever = HybridRetriever(
+            retriever, bm25_index_path, candidates=hybrid_candidates, rrf_k=rrf_k, reload_interval=bm25_reload_interval
+        )
+    if typed:
+        images = QdrantRetriever(
+            qdrant_client, collection_name, search_params=search_params, with_payload=with_payload,
+            chunk_types=IMAGE_CHUNK_TYPES,
+        )
+        retriever = TypedRetriever(retriever, images, max_images=max_images, image_candidates=image_candidates)
+    return retriever
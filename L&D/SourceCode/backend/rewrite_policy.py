@@ -0,0 +1,73 @@
+"""rewrite_policy.py
+
+Decides whether a question needs the LLM rewrite before retrieval, and memoises the rewrites that do
+run. The check is deliberately conservative: anything that might lean on earlier turns is sent to the
+rewrite, so a false negative only costs the call we would have made anyway.
+"""
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+# Words that usually point back at something said earlier in the conversation.
+_REFERRING_WORDS = {
+    "it", "its", "this", "these", "those", "they", "them", "their", "theirs",
+    "he", "she", "him", "her", "his", "hers", "there", "above", "previous", "previously",
+    "earlier", "former", "latter", "same", "again", "else", "instead",
+}
+_LEADING_CONNECTIVES = ("and ", "but ", "or ", "so ", "also ", "then ", "what about", "how about")
+_PRIOR_TURN_PATTERN = re.compile(
+    r"\b(you (said|mentioned|suggested)|as (above|before)|the (last|previous|next) (step|one|answer|question)"
+    r"|that (step|one|screen|card|section|option)|step \d+|more detail)\b|\bthat\s*[?.!,]",
+    re.IGNORECASE,
+)
+_MIN_SELF_CONTAINED_WORDS = 4
+
+
+def is_self_contained(question: str) -> bool:
+    """True when the question reads as a complete search query without any prior turn."""
+    text = (question or "").strip()
+    if "..." in text or "…" in text:
+        return False
+    lowered = text.lower()
+    if lowered.startswith(_LEADING_CONNECTIVES):
+        return False
+    words = re.findall(r"[a-z']+", lowered)
+    if len(words) < _MIN_SELF_CONTAINED_WORDS:
+        return False
+    if any(word in _REFERRING_WORDS for word in words):
+        return False
+    return not _PRIOR_TURN_PATTERN.search(text)
+
+
+def rewrite_key(history_text: str, case_context: str, question: str) -> str:
+    """Memo key for a rewrite: hash of the history plus the exact context and question."""
+    digest = hashlib.sha256()
+    for part in (history_text, case_context, question.strip()):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+class RewriteMemo:
+    """Small thread-safe LRU of rewrite key -> standalone question."""
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: str) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
@@ -0,0 +1,44 @@
+"""rate_limiter.py
+
+Client-side requests- and tokens-per-minute limiter for Azure OpenAI deployments.
+
+Shared by the ingest step's bulk embedding and the doc-chunker's image captioning. It depends only
+on the standard library, so either can import it without the backend's dependencies.
+"""
+import asyncio
+import time
+
+
+class RateLimiter:
+    """Token-bucket limiter for requests and tokens per minute; waiters are served in arrival order."""
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = float(requests_per_minute)
+        self._tokens = float(tokens_per_minute)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens: int) -> None:
+        # A single batch bigger than the per-minute quota could never fit; let it through on a full bucket.
+        tokens = min(tokens, self.tokens_per_minute)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._requests >= 1 and self._tokens >= tokens:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return
+                wait = max(
+                    (1 - self._requests) / self.requests_per_minute,
+                    (tokens - self._tokens) / self.tokens_per_minute,
+                ) * 60
+                await asyncio.sleep(wait)
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed_minutes = (now - self._updated) / 60
+        self._updated = now
+        self._requests = min(self.requests_per_minute, self._requests + elapsed_minutes * self.requests_per_minute)
+        self._tokens = min(self.tokens_per_minute, self._tokens + elapsed_minutes * self.tokens_per_minute)
@@ -2,11 +2,19 @@ import fitz  # PyMuPDF
 import re
 import json
 import os
+import sys
+import asyncio
 import base64
 import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from dotenv import load_dotenv
-from openai import AzureOpenAI  
+from openai import AsyncAzureOpenAI
+
+# The rate limiter is shared with ingest's bulk embedding; common/ holds only dependency-free modules.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from rate_limiter import RateLimiter
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -20,14 +28,16 @@ azure_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
 api_version = os.getenv("AZURE_OPENAI_API_VERSION")
 print("api_key:", "****" if api_key else None)
 
-# Initialize Azure OpenAI client
-client = AzureOpenAI(
-    azure_deployment="gpt-4.1",
-    api_version=api_version,
-    api_key=api_key,
-    azure_endpoint=azure_endpoint,
-    max_retries=2,
-)
+# Captioning runs concurrently: at most CAPTION_CONCURRENCY requests in flight, kept inside the
+# deployment's requests- and tokens-per-minute quota. Each request is counted as
+# CAPTION_TOKENS_PER_IMAGE tokens (prompt, image tiles and caption) against the TPM limit. Throttled
+# and failed requests are retried by the OpenAI client, which honours Retry-After.
+CAPTION_DEPLOYMENT = os.getenv("CAPTION_DEPLOYMENT", "gpt-4.1")
+CAPTION_CONCURRENCY = int(os.getenv("CAPTION_CONCURRENCY", "8"))
+CAPTION_REQUESTS_PER_MINUTE = float(os.getenv("CAPTION_REQUESTS_PER_MINUTE", "300"))
+CAPTION_TOKENS_PER_MINUTE = float(os.getenv("CAPTION_TOKENS_PER_MINUTE", "150000"))
+CAPTION_TOKENS_PER_IMAGE = int(os.getenv("CAPTION_TOKENS_PER_IMAGE", "1500"))
+CAPTION_MAX_ATTEMPTS = int(os.getenv("CAPTION_MAX_ATTEMPTS", "6"))
 
 # Define the police-oriented prompt globally
 POLICE_CAPTION_PROMPT = (
@@ -50,26 +60,133 @@ def _encode_image(image_path):
         return None
 
 
-def generate_caption_with_azure(client, prompt, image_b64, deployment="gpt-4.1"):
-    """Generate an image caption using Azure OpenAI."""
-    try:
-        response = client.chat.completions.create(
-            model=deployment,  # Azure deployment model name
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_b64}"}},
-                    ],
-                }
-            ],
-            temperature=0,
+def _in_content_area(bbox: tuple, content_y_start: float, content_y_end: float) -> bool:
+    _x0, y0, _x1, y1 = bbox
+    return content_y_start < y0 and y1 < content_y_end
+
+
+def _extract_page_elements(doc, page_number: int, image_dir: str, content_y_start: float, content_y_end: float) -> list:
+    """
+    Layout work for one page: text blocks, images (written to image_dir) and tables inside the content
+    area, as plain picklable elements sorted top to bottom.
+    """
+    page = doc[page_number - 1]
+    elements = []
+
+    for block in page.get_text("blocks", sort=False):
+        if _in_content_area(block[:4], content_y_start, content_y_end):
+            elements.append({"type": "text", "y0": block[1], "data": block})
+
+    for img_index, img_info in enumerate(page.get_images(full=True)):
+        img_bbox = page.get_image_bbox(img_info)
+        if not _in_content_area(img_bbox, content_y_start, content_y_end):
+            continue
+        try:
+            xref = img_info[0]
+            base_image = doc.extract_image(xref)
+            image_filename = f"p{page_number}_i{img_index}.{base_image['ext']}"
+            image_path = os.path.join(image_dir, image_filename)
+            with open(image_path, "wb") as f:
+                f.write(base_image["image"])
+            elements.append({"type": "image", "y0": img_bbox[1], "data": (image_filename, image_path)})
+        except Exception as e:
+            logging.error(f"Could not process image on page {page_number}: {e}")
+
+    for table in page.find_tables():
+        if _in_content_area(table.bbox, content_y_start, content_y_end):
+            elements.append({"type": "table", "y0": table.bbox[1], "data": table.extract()})
+
+    elements.sort(key=lambda x: x["y0"])
+    return elements
+
+
+# Each worker process opens the PDF once and keeps it for all the pages it is given.
+_worker_doc = None
+_worker_args = None
+
+
+def _init_page_worker(pdf_path: str, image_dir: str, content_y_start: float, content_y_end: float):
+    global _worker_doc, _worker_args
+    _worker_doc = fitz.open(pdf_path)
+    _worker_args = (image_dir, content_y_start, content_y_end)
+
+
+def _extract_page_in_worker(page_number: int) -> list:
+    return _extract_page_elements(_worker_doc, page_number, *_worker_args)
+
+
+class CaptionPool:
+    """
+    Captions images on a background event loop while the caller keeps extracting. `submit` returns at
+    once; `wait` blocks until every caption is back and hands each one to its callback, in submission
+    order, on the calling thread.
+    """
+
+    def __init__(self, prompt: str, deployment: str = CAPTION_DEPLOYMENT, concurrency: int = CAPTION_CONCURRENCY,
+                 requests_per_minute: float = CAPTION_REQUESTS_PER_MINUTE,
+                 tokens_per_minute: float = CAPTION_TOKENS_PER_MINUTE,
+                 tokens_per_image: int = CAPTION_TOKENS_PER_IMAGE):
+        self.prompt = prompt
+        self.deployment = deployment
+        self.tokens_per_image = tokens_per_image
+        self.client = AsyncAzureOpenAI(
+            azure_deployment=deployment,
+            api_version=api_version,
+            api_key=api_key,
+            azure_endpoint=azure_endpoint,
+            max_retries=CAPTION_MAX_ATTEMPTS - 1,
         )
-        return response.choices[0].message.content
-    except Exception as e:
-        logging.error(f"Error generating caption: {e}")
-        return f"Error: Failed to generate caption. {e}"
+        self._slots = asyncio.Semaphore(concurrency)
+        self._limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self._pending = []
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="caption-pool", daemon=True)
+        self._thread.start()
+
+    def submit(self, image_path: str, on_caption) -> None:
+        future = asyncio.run_coroutine_threadsafe(self._caption(image_path), self._loop)
+        self._pending.append((future, on_caption))
+
+    def wait(self) -> None:
+        try:
+            for i, (future, on_caption) in enumerate(self._pending, 1):
+                on_caption(future.result())
+                if i % 25 == 0 or i == len(self._pending):
+                    logging.info(f"Captioned {i}/{len(self._pending)} images.")
+        finally:
+            self._pending = []
+            asyncio.run_coroutine_threadsafe(self.client.close(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+
+    async def _caption(self, image_path: str) -> str:
+        image_name = Path(image_path).name
+        try:
+            # Encode inside the slot so at most `concurrency` base64 images are held in memory.
+            async with self._slots:
+                image_data = await asyncio.to_thread(_encode_image, image_path)
+                if image_data is None:
+                    return f"Error: Could not encode image {image_name}"
+                await self._limiter.acquire(self.tokens_per_image)
+                logging.info(f"Generating caption for image: {image_name}")
+                response = await self.client.chat.completions.create(
+                    model=self.deployment,
+                    messages=[
+                        {
+                            "role": "user",
+                            "content": [
+                                {"type": "text", "text": self.prompt},
+                                {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_data}"}},
+                            ],
+                        }
+                    ],
+                    temperature=0,
+                )
+            return response.choices[0].message.content
+        except Exception as e:
+            logging.error(f"Error generating caption for {image_name}: {e}")
+            return f"Error: Failed to generate caption. {e}"
 
 
 class PDFSectionExtractor:
@@ -79,6 +196,7 @@ class PDFSectionExtractor:
         if not os.path.exists(pdf_path):
             raise FileNotFoundError(f"The file {pdf_path} was not found.")
         self.pdf_path = os.path.basename(pdf_path)
+        self.source_path = os.path.abspath(pdf_path)
         self.doc = fitz.open(pdf_path)
         self.caption_prompt = caption_prompt
 
@@ -121,8 +239,7 @@ class PDFSectionExtractor:
                 logging.info(f"Extracted Document Subtitle: {self.subtitle}")
 
     def _is_in_content_area(self, bbox: tuple) -> bool:
-        _x0, y0, _x1, y1 = bbox
-        return self.content_y_start < y0 and y1 < self.content_y_end
+        return _in_content_area(bbox, self.content_y_start, self.content_y_end)
 
     def _parse_section_header(self, text: str) -> tuple | None:
         match = self.section_header_regex.match(text)
@@ -171,51 +288,37 @@ class PDFSectionExtractor:
                 }
                 self.chunks.append(section_data_with_metadata)
 
-    def _generate_caption_for_image(self, image_path: str) -> str:
-        image_name = Path(image_path).name
-        logging.info(f"Generating caption for image: {image_name}")
-        image_data = _encode_image(image_path)
+    def _create_caption_pool(self) -> CaptionPool:
+        return CaptionPool(self.caption_prompt)
 
-        if image_data is None:
-            return f"Error: Could not encode image {image_name}"
+    def _iter_page_elements(self, page_numbers: list, image_dir: str, workers: int):
+        """Yields (page number, elements) in page order; the layout work runs in `workers` processes."""
+        layout_args = (image_dir, self.content_y_start, self.content_y_end)
+        if workers <= 1 or len(page_numbers) < 2:
+            for page_number in page_numbers:
+                yield page_number, _extract_page_elements(self.doc, page_number, *layout_args)
+            return
 
-        return generate_caption_with_azure(
-            client, self.caption_prompt, image_data, deployment="gpt-4.1"
-        )
+        # Contiguous runs of pages per task keep inter-process traffic low; map() returns them in order.
+        chunksize = max(1, len(page_numbers) // (workers * 4))
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_page_worker, initargs=(self.source_path, *layout_args)
+        ) as executor:
+            yield from zip(page_numbers, executor.map(_extract_page_in_worker, page_numbers, chunksize=chunksize))
 
-    def extract(self, image_dir: str = "extracted_images_updated_22082025") -> list:
+    def extract(self, image_dir: str = "extracted_images_updated_22082025", workers: int | None = None) -> list:
         os.makedirs(image_dir, exist_ok=True)
         toc_pages = self._process_toc()
         active_section = None
+        if workers is None:
+            workers = int(os.getenv("CHUNKER_WORKERS", os.cpu_count() or 1))
 
-        print("Starting PDF content and image extraction...")
-
-        for page_num, page in enumerate(self.doc):
-            page_number = page_num + 1
-            if page_number in toc_pages:
-                continue
-
-            page_blocks = page.get_text("blocks", sort=False)
-            page_images = page.get_images(full=True)
-            page_tables = page.find_tables()
-
-            elements = []
-
-            for block in page_blocks:
-                if self._is_in_content_area(block[:4]):
-                    elements.append({"type": "text", "y0": block[1], "data": block})
-
-            for img_index, img_info in enumerate(page_images):
-                img_bbox = page.get_image_bbox(img_info)
-                if self._is_in_content_area(img_bbox):
-                    elements.append({"type": "image", "y0": img_bbox[1], "data": (img_info, img_bbox, img_index)})
-
-            for table in page_tables:
-                if self._is_in_content_area(table.bbox):
-                    elements.append({"type": "table", "y0": table.bbox[1], "data": table})
-
-            elements.sort(key=lambda x: x["y0"])
+        print(f"Starting PDF content and image extraction ({workers} worker process(es))...")
+        # Image chunks are added with an empty caption and filled in once the pool returns it.
+        caption_pool = self._create_caption_pool()
 
+        page_numbers = [n for n in range(1, self.doc.page_count + 1) if n not in toc_pages]
+        for page_number, elements in self._iter_page_elements(page_numbers, image_dir, workers):
             for element in elements:
                 if element["type"] == "text":
                     block = element["data"]
@@ -243,18 +346,8 @@ class PDFSectionExtractor:
                         active_section["has_content"] = True
 
                 elif element["type"] == "image":
-                    img_info, img_bbox, img_index = element["data"]
+                    image_filename, image_path = element["data"]
                     try:
-                        xref = img_info[0]
-                        base_image = self.doc.extract_image(xref)
-                        image_filename = f"p{page_number}_i{img_index}.{base_image['ext']}"
-                        image_path = os.path.join(image_dir, image_filename)
-
-                        with open(image_path, "wb") as f:
-                            f.write(base_image["image"])
-
-                        generated_caption = self._generate_caption_for_image(image_path)
-
                         img_chunk = {
                             "document": self.pdf_path,
                             "title": self.title,
@@ -262,8 +355,9 @@ class PDFSectionExtractor:
                             "type": "image",
                             "page_number": page_number,
                             "payload": {"path": image_path},
-                            "content": generated_caption,
+                            "content": None,
                         }
+                        caption_pool.submit(image_path, lambda caption, chunk=img_chunk: chunk.update(content=caption))
 
                         if active_section:
                             img_chunk["section_number"] = active_section.get("section_number")
@@ -281,14 +375,14 @@ class PDFSectionExtractor:
                         logging.error(f"Could not process image on page {page_number}: {e}")
 
                 elif element["type"] == "table":
-                    table = element["data"]
-                    extracted_data = table.extract()
-                    table_plain_text = self._convert_table_to_flattened_plain_text(extracted_data)
+                    table_plain_text = self._convert_table_to_flattened_plain_text(element["data"])
                     if active_section:
                         active_section["content"] += table_plain_text
                         active_section["has_content"] = True
 
         self._finalize_section(active_section)
+        print("Finished layout extraction; waiting for image captions...")
+        caption_pool.wait()
         print("Finished PDF content and image extraction.")
         return self.chunks
 
@@ -0,0 +1,80 @@
+"""batch_embedder.py
+
+Bulk embedding for ingest jobs.
+
+Texts are packed into batches bounded by tokens and by input count, and several batches are sent
+concurrently. A client-side limiter (common/rate_limiter.py) keeps the job inside the deployment's requests-per-minute and
+tokens-per-minute quota, so it does not lean on 429s to pace itself. Failed batches are retried
+with the same jittered backoff as the API (azure_transport.call_with_retry). A batch that still
+fails aborts the job instead of leaving chunks out of the collection.
+"""
+import asyncio
+from typing import Callable, List, Optional
+
+from azure_transport import call_with_retry
+from context_packer import count_tokens, truncate_to_tokens
+from rate_limiter import RateLimiter
+
+# text-embedding-3-* models reject single inputs longer than this.
+MAX_INPUT_TOKENS = 8191
+
+
+def token_batches(token_counts: List[int], max_batch_tokens: int, max_batch_inputs: int) -> List[List[int]]:
+    """Packs text indices, in order, into batches within the token and input limits."""
+    batches, current, current_tokens = [], [], 0
+    for i, tokens in enumerate(token_counts):
+        if current and (current_tokens + tokens > max_batch_tokens or len(current) >= max_batch_inputs):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+async def embed_texts(client, deployment: str, texts: List[str], max_batch_tokens: int = 32000,
+                      max_batch_inputs: int = 256, concurrency: int = 4, requests_per_minute: float = 2100,
+                      tokens_per_minute: float = 350000, max_attempts: int = 6,
+                      on_progress: Optional[Callable[[int], None]] = None,
+                      limiter: Optional[RateLimiter] = None) -> List[List[float]]:
+    """
+    Embeds `texts` with an AsyncAzureOpenAI client and returns the vectors in input order. Pass a
+    shared `limiter` when calling repeatedly so the quota holds across calls.
+    """
+    inputs, token_counts = [], []
+    for i, text in enumerate(texts):
+        tokens = count_tokens(text)
+        if tokens > MAX_INPUT_TOKENS:
+            print(f"WARN: Text {i} has {tokens} tokens; embedding its first {MAX_INPUT_TOKENS}.")
+            text, tokens = truncate_to_tokens(text, MAX_INPUT_TOKENS), MAX_INPUT_TOKENS
+        inputs.append(text)
+        token_counts.append(tokens)
+
+    limiter = limiter or RateLimiter(requests_per_minute, tokens_per_minute)
+    slots = asyncio.Semaphore(concurrency)
+    vectors = [None] * len(texts)
+
+    async def embed_batch(indices):
+        batch_tokens = sum(token_counts[i] for i in indices)
+
+        async def make_call():
+            await limiter.acquire(batch_tokens)
+            return await client.embeddings.create(input=[inputs[i] for i in indices], model=deployment)
+
+        async with slots:
+            response = await call_with_retry("ingest_embedding", make_call, max_attempts=max_attempts, max_delay=60.0)
+        for item in response.data:
+            vectors[indices[item.index]] = item.embedding
+        if on_progress:
+            on_progress(len(indices))
+
+    batches = token_batches(token_counts, max_batch_tokens, max_batch_inputs)
+    tasks = [asyncio.create_task(embed_batch(indices)) for indices in batches]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    return vectors
@@ -0,0 +1,146 @@
+# chunk_dedupe.py
+#
+# Near-duplicate chunk elimination between the chunker output and Qdrant.
+#
+# The manual repeats the same screenshots (toolbars, card layouts) and boilerplate paragraphs many
+# times, so the chunker emits many captions and sections that differ by a word or two. Each chunk is
+# reduced to a MinHash signature over word shingles; locality-sensitive hashing on bands of the
+# signature finds candidate matches, and a chunk whose estimated Jaccard similarity to an earlier
+# canonical chunk of the same type reaches the threshold is folded into it. The canonical chunk (the
+# first one in document order) is kept with an `occurrences` list of every section and page where
+# the text appears; the duplicates are not embedded or stored.
+#
+# Only signatures are held in memory, so the stage works on the streamed chunks of ingest_pipeline.
+#
+# Preview what would be folded, or write a deduplicated JSONL file:
+#     python chunk_dedupe.py extracted_content.json [--out deduped.jsonl] [--threshold 0.85]
+
+import argparse
+import hashlib
+import json
+import re
+
+import numpy as np
+
+# Signature length and LSH banding: 16 bands of 8 rows find pairs above ~0.7 Jaccard with high
+# probability; candidates are then checked against the actual threshold.
+NUM_PERM = 128
+BANDS = 16
+SHINGLE_SIZE = 3
+
+# Smallest prime above 2**32, so (a * x + b) % p stays inside uint64 for 32-bit a, b and x.
+_PRIME = np.uint64(4294967311)
+
+# Fields recorded for every place a canonical chunk's text appears.
+OCCURRENCE_FIELDS = ("section_number", "section_title", "page_number")
+
+
+def shingles(text, size=SHINGLE_SIZE):
+    """Lower-cased word n-grams; a text shorter than `size` words is a single shingle."""
+    words = re.findall(r"\w+", (text or "").lower())
+    if len(words) <= size:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+class MinHasher:
+    def __init__(self, num_perm=NUM_PERM, seed=1):
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, 2 ** 32, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, 2 ** 32, size=num_perm, dtype=np.uint64)
+
+    def signature(self, shingle_set):
+        hashes = np.fromiter(
+            (int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=4).digest(), "little") for s in shingle_set),
+            dtype=np.uint64,
+            count=len(shingle_set),
+        )
+        return ((np.outer(hashes, self.a) + self.b) % _PRIME).min(axis=0)
+
+
+class DedupePlan:
+    """Result of a dedupe pass: duplicate point id -> canonical point id, and canonical id -> occurrences."""
+
+    def __init__(self):
+        self.duplicates = {}
+        self.occurrences = {}
+
+    def apply(self, points):
+        """Yields the canonical (point id, chunk) pairs, each with its `occurrences` when it has duplicates."""
+        for point_id, chunk in points:
+            if point_id in self.duplicates:
+                continue
+            if len(self.occurrences.get(point_id, ())) > 1:
+                chunk = {**chunk, "occurrences": self.occurrences[point_id]}
+            yield point_id, chunk
+
+    def summary(self):
+        clusters = sum(1 for refs in self.occurrences.values() if len(refs) > 1)
+        return f"{len(self.duplicates)} near-duplicate chunks folded into {clusters} canonical chunks"
+
+
+def build_dedupe_plan(points, threshold=0.85, num_perm=NUM_PERM, bands=BANDS):
+    """
+    Clusters (point id, chunk) pairs in document order. Each chunk joins the first earlier canonical
+    chunk of the same type it matches, rather than any cluster member, so clusters cannot drift
+    through chains of small edits.
+    """
+    rows = num_perm // bands
+    hasher = MinHasher(num_perm)
+    plan = DedupePlan()
+    buckets = {}
+    signatures = {}
+    for point_id, chunk in points:
+        signature = hasher.signature(shingles(chunk.get("content", "")))
+        chunk_type = chunk.get("type")
+        band_keys = [(chunk_type, band, signature[band * rows:(band + 1) * rows].tobytes()) for band in range(bands)]
+
+        canonical_id = None
+        for key in band_keys:
+            for candidate in buckets.get(key, ()):
+                if float(np.mean(signatures[candidate] == signature)) >= threshold:
+                    canonical_id = candidate
+                    break
+            if canonical_id:
+                break
+
+        reference = {field: chunk.get(field) for field in OCCURRENCE_FIELDS}
+        if canonical_id:
+            plan.duplicates[point_id] = canonical_id
+            plan.occurrences[canonical_id].append(reference)
+            continue
+        signatures[point_id] = signature
+        plan.occurrences[point_id] = [reference]
+        for key in band_keys:
+            buckets.setdefault(key, []).append(point_id)
+    return plan
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+
+    from ingest_pipeline import iter_chunks
+
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+    from point_ids import with_point_ids
+
+    parser = argparse.ArgumentParser(description="Fold near-duplicate chunks into canonical chunks.")
+    parser.add_argument("source")
+    parser.add_argument("--out", help="Write the deduplicated chunks to this JSONL file.")
+    parser.add_argument("--threshold", type=float, default=float(os.getenv("DEDUPE_THRESHOLD", "0.85")))
+    args = parser.parse_args()
+
+    def text_points():
+        return with_point_ids((c for c in iter_chunks(args.source) if c.get("content")), warn=False)
+
+    dedupe_plan = build_dedupe_plan(text_points(), args.threshold)
+    print(dedupe_plan.summary())
+    for canonical, refs in dedupe_plan.occurrences.items():
+        if len(refs) > 1:
+            print(f"  {len(refs)}x sections {', '.join(str(r['section_number']) for r in refs)}")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            for _point_id, chunk in dedupe_plan.apply(text_points()):
+                f.write(json.dumps(chunk, ensure_ascii=False) + "\n")
+        print(f"Wrote deduplicated chunks to '{args.out}'.")
@@ -0,0 +1,202 @@
+"""collection_versions.py
+
+Versioned manual collections behind a Qdrant alias.
+
+A full ingest builds into a fresh collection named `<name>__<YYYYmmddHHMMSS>`, checks it with a smoke
+test and then moves the alias `<name>` onto it in one atomic alias update. The backend only ever
+queries the alias, so searches never see an empty or half-built collection. Previous versions are
+kept (COLLECTION_VERSIONS_TO_KEEP, counting the live one) so a bad publish can be rolled back
+instantly by pointing the alias back.
+
+The BM25 index is versioned the same way: ingest writes it next to the versioned collection and a
+publish copies it over the alias's index file.
+
+The backend notices a switch through the retriever fingerprint, which includes the collection the
+alias resolves to, and drops every answer cached for the old version.
+
+Smoke queries (optional) are a JSON list; a query passes when one of its expected sections is in
+the top hits:
+    [{"question": "How do I reassign an investigation?", "expected_sections": ["4.2", "4.2.1"]}]
+
+List, roll back or switch versions by hand:
+    python collection_versions.py --collection <name> --list
+    python collection_versions.py --collection <name> --rollback
+    python collection_versions.py --collection <name> --switch <name>__20250101120000
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import time
+from typing import List, Optional
+
+from qdrant_client import models
+
+_VERSION_SUFFIX = re.compile(r"__(\d{14})$")
+
+
+def versioned_name(alias: str, now: Optional[float] = None) -> str:
+    return f"{alias}__{time.strftime('%Y%m%d%H%M%S', time.localtime(now))}"
+
+
+def list_versions(client, alias: str) -> List[str]:
+    """Versioned collections of `alias`, oldest first."""
+    names = [c.name for c in client.get_collections().collections]
+    return sorted(n for n in names if n.startswith(alias) and _VERSION_SUFFIX.fullmatch(n[len(alias):]))
+
+
+def current_version(client, alias: str) -> Optional[str]:
+    """The collection `alias` points to, or None when it is not an alias."""
+    for description in client.get_aliases().aliases:
+        if description.alias_name == alias:
+            return description.collection_name
+    return None
+
+
+def resolve_collection(client, alias: str) -> Optional[str]:
+    """Collection serving `alias`: its alias target, a plain collection of that name, or None."""
+    target = current_version(client, alias)
+    if target is None and client.collection_exists(alias):
+        return alias
+    return target
+
+
+def switch_alias(client, alias: str, collection: str) -> None:
+    """Points `alias` at `collection` in a single alias update, so no search sees a gap."""
+    previous = current_version(client, alias)
+    if previous is None and client.collection_exists(alias):
+        # A collection ingested before versioning holds the name; it has to go before the alias can exist.
+        print(f"WARN: Replacing the unversioned collection '{alias}' with an alias; it cannot be rolled back to.")
+        client.delete_collection(alias)
+    operations = []
+    if previous is not None:
+        operations.append(models.DeleteAliasOperation(delete_alias=models.DeleteAlias(alias_name=alias)))
+    operations.append(models.CreateAliasOperation(
+        create_alias=models.CreateAlias(collection_name=collection, alias_name=alias)
+    ))
+    client.update_collection_aliases(change_aliases_operations=operations)
+    publish_bm25_index(alias, collection)
+    print(f"Alias '{alias}' now points to '{collection}'" + (f" (was '{previous}')." if previous else "."))
+
+
+def rollback(client, alias: str) -> str:
+    """Points `alias` back at the version before the live one; returns that version."""
+    live = current_version(client, alias)
+    older = [v for v in list_versions(client, alias) if live is None or v < live]
+    if not older:
+        raise ValueError(f"No version of '{alias}' older than '{live}' to roll back to.")
+    switch_alias(client, alias, older[-1])
+    return older[-1]
+
+
+def prune_versions(client, alias: str, keep: int) -> List[str]:
+    """Deletes all but the newest `keep` versions; the live version is never deleted."""
+    live = current_version(client, alias)
+    versions = list_versions(client, alias)
+    doomed = [v for v in versions[:max(len(versions) - keep, 0)] if v != live]
+    for version in doomed:
+        _delete_version(client, version)
+    return doomed
+
+
+def discard_unpublished(client, alias: str) -> List[str]:
+    """
+    Deletes versions newer than the live one: builds that failed their smoke test or were abandoned,
+    and versions rolled back from. This keeps every version older than the live one a rollback target.
+    """
+    live = current_version(client, alias)
+    doomed = [v for v in list_versions(client, alias) if live is None or v > live]
+    for version in doomed:
+        _delete_version(client, version)
+    return doomed
+
+
+def _delete_version(client, version: str) -> None:
+    from bm25_index import default_index_path
+
+    client.delete_collection(version)
+    if os.path.exists(default_index_path(version)):
+        os.remove(default_index_path(version))
+    print(f"Deleted version '{version}'.")
+
+
+def publish_bm25_index(alias: str, collection: str) -> None:
+    """Copies a version's BM25 index over the alias's index file, which is what the backend loads."""
+    from bm25_index import default_index_path
+
+    source = default_index_path(collection)
+    if collection == alias or not os.path.exists(source):
+        return
+    target = default_index_path(alias)
+    shutil.copyfile(source, target + ".tmp")
+    os.replace(target + ".tmp", target)
+
+
+def load_smoke_queries(path: Optional[str]) -> List[dict]:
+    if not path or not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def smoke_test(client, collection: str, expected_points: int, query_vectors=None, queries=None,
+               sample_size: int = 5, top_k: int = 5) -> List[str]:
+    """
+    Checks a freshly built collection before it is published and returns the failures (empty when it
+    passes): the point count must match the source, a sample of stored points must find themselves
+    among the top hits, and each smoke query (embedded in `query_vectors`) must hit an expected section.
+    """
+    failures = []
+    count = client.count(collection_name=collection, exact=True).count
+    if count != expected_points:
+        failures.append(f"'{collection}' holds {count} points, expected {expected_points}.")
+    if count == 0:
+        return failures
+
+    sample, _offset = client.scroll(collection_name=collection, limit=sample_size, with_payload=False, with_vectors=True)
+    for point in sample:
+        # Chunks with identical text share a vector, so look a little past the first hit.
+        hits = client.search(collection_name=collection, query_vector=point.vector, limit=top_k, with_payload=False)
+        if str(point.id) not in {str(hit.id) for hit in hits}:
+            failures.append(f"Point {point.id} does not retrieve itself.")
+
+    for query, vector in zip(queries or [], query_vectors or []):
+        hits = client.search(
+            collection_name=collection,
+            query_vector=vector,
+            limit=top_k,
+            with_payload=models.PayloadSelectorInclude(include=["section_number"]),
+        )
+        found = [str((hit.payload or {}).get("section_number")) for hit in hits]
+        expected = [str(section) for section in query.get("expected_sections", [])]
+        if expected and not set(found) & set(expected):
+            failures.append(f"'{query['question']}' expected sections {expected}, got {found}.")
+    return failures
+
+
+if __name__ == "__main__":
+    import sys
+
+    from qdrant_client import QdrantClient
+
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+    parser = argparse.ArgumentParser(description="List, switch or roll back the versions behind a collection alias.")
+    parser.add_argument("--collection", required=True, help="Alias the backend queries.")
+    action = parser.add_mutually_exclusive_group(required=True)
+    action.add_argument("--list", action="store_true")
+    action.add_argument("--rollback", action="store_true")
+    action.add_argument("--switch", metavar="VERSION")
+    parser.add_argument("--qdrant-url", default="http://localhost:6333")
+    args = parser.parse_args()
+
+    qdrant = QdrantClient(args.qdrant_url)
+    if args.list:
+        live = current_version(qdrant, args.collection)
+        for version in list_versions(qdrant, args.collection):
+            print(("* " if version == live else "  ") + version)
+    elif args.rollback:
+        rollback(qdrant, args.collection)
+    else:
+        switch_alias(qdrant, args.collection, args.switch)
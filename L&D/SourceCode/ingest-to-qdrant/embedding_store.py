@@ -0,0 +1,232 @@
+"""embedding_store.py
+
+Persistent, content-addressed store of chunk embeddings for ingest.
+
+A vector is keyed by the embedding deployment that produced it and the SHA-256 of the chunk's normalised text, so a
+section that is word-for-word identical between manual revisions (or collections) is embedded once
+and reused by every later ingest. The store is a directory holding two files:
+
+    vectors-<generation>.f32   float32 rows, appended to and never rewritten in place
+    index.tsv                  header line naming the vectors file, then one line per vector:
+                               model <TAB> sha256 <TAB> byte offset <TAB> dimension
+
+A vector is written before its index line, so a crash mid-write leaves at most an unreferenced
+tail. Compaction writes the live rows to a new generation and swaps the index in one rename.
+The store assumes a single writer at a time.
+
+Share the store across nodes or with CI as one file:
+    python embedding_store.py --dir <store> --export embeddings.npz
+    python embedding_store.py --dir <store> --import embeddings.npz
+    python embedding_store.py --dir <store> --compact [--model <embedding deployment>]
+"""
+import argparse
+import hashlib
+import os
+import re
+import threading
+import unicodedata
+from typing import Iterable, List, Optional
+
+import numpy as np
+
+_INDEX_FILE = "index.tsv"
+
+
+def normalise_text(text: str) -> str:
+    """Unicode-normalises and collapses whitespace; case is kept since it can change the embedding."""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text or "")).strip()
+
+
+def content_digest(text: str) -> str:
+    return hashlib.sha256(normalise_text(text).encode("utf-8")).hexdigest()
+
+
+def _index_header(generation: int) -> str:
+    return f"# vectors-{generation}.f32\n"
+
+
+def default_store_dir() -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "embedding_store")
+
+
+class EmbeddingStore:
+    """Append-only float32 vector file plus an in-memory index of (model, digest) -> (offset, dimension)."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._index = {}
+        self._generation = 0
+        self._load_index()
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def models(self) -> List[str]:
+        return sorted({model for model, _digest in self._index})
+
+    @property
+    def vectors_path(self) -> str:
+        return os.path.join(self.directory, f"vectors-{self._generation}.f32")
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.directory, _INDEX_FILE)
+
+    def get_many(self, model: str, texts: List[str], dimension: Optional[int] = None) -> List[Optional[List[float]]]:
+        """Stored vectors for `texts` in order, None for misses (and for vectors of another dimension)."""
+        keys = [(model, content_digest(text)) for text in texts]
+        results = [None] * len(texts)
+        with self._lock:
+            hits = [(i, self._index[key]) for i, key in enumerate(keys) if key in self._index]
+            if not hits:
+                return results
+            with open(self.vectors_path, "rb") as f:
+                for i, (offset, dim) in hits:
+                    if dimension is not None and dim != dimension:
+                        continue
+                    f.seek(offset)
+                    results[i] = np.fromfile(f, dtype=np.float32, count=dim).tolist()
+        return results
+
+    def put_many(self, model: str, texts: List[str], vectors: List[List[float]]) -> int:
+        """Appends the vectors not stored yet; returns how many were added."""
+        digests = [content_digest(text) for text in texts]
+        with self._lock:
+            return self._append(model, digests, vectors)
+
+    def compact(self, models: Optional[Iterable[str]] = None) -> int:
+        """
+        Rewrites the store with one row per key, dropping unreferenced bytes and, when `models` is
+        given, every other model's vectors. Returns the number of vectors kept.
+        """
+        keep_models = set(models) if models else None
+        with self._lock:
+            old_vectors_path = self.vectors_path
+            if not os.path.exists(old_vectors_path):
+                return 0
+            entries = sorted(
+                (key, location) for key, location in self._index.items()
+                if keep_models is None or key[0] in keep_models
+            )
+            generation = self._generation + 1
+            new_vectors_path = os.path.join(self.directory, f"vectors-{generation}.f32")
+            new_index, lines, offset = {}, [], 0
+            with open(old_vectors_path, "rb") as src, open(new_vectors_path, "wb") as dst:
+                for (model, digest), (old_offset, dim) in entries:
+                    src.seek(old_offset)
+                    dst.write(src.read(dim * 4))
+                    new_index[(model, digest)] = (offset, dim)
+                    lines.append(f"{model}\t{digest}\t{offset}\t{dim}\n")
+                    offset += dim * 4
+                dst.flush()
+                os.fsync(dst.fileno())
+            tmp_index = self.index_path + ".tmp"
+            with open(tmp_index, "w", encoding="utf-8") as f:
+                f.write(_index_header(generation))
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_index, self.index_path)
+            self._index, self._generation = new_index, generation
+            os.remove(old_vectors_path)
+        print(f"Compacted embedding store '{self.directory}' to {len(new_index)} vectors ({offset / 1e6:.1f} MB).")
+        return len(new_index)
+
+    def export(self, path: str) -> int:
+        """Writes every vector to a single .npz file that `import_file` can read."""
+        with self._lock:
+            entries = sorted(self._index.items())
+            data = []
+            with open(self.vectors_path, "rb") as f:
+                for _key, (offset, dim) in entries:
+                    f.seek(offset)
+                    data.append(np.fromfile(f, dtype=np.float32, count=dim))
+        np.savez(
+            path,
+            models=np.array([model for (model, _digest), _location in entries], dtype=str),
+            digests=np.array([digest for (_model, digest), _location in entries], dtype=str),
+            dims=np.array([dim for _key, (_offset, dim) in entries], dtype=np.int32),
+            data=np.concatenate(data) if data else np.zeros(0, dtype=np.float32),
+        )
+        print(f"Exported {len(entries)} vectors to '{path}'.")
+        return len(entries)
+
+    def import_file(self, path: str) -> int:
+        """Adds the vectors from an exported file that are not stored yet; returns how many were added."""
+        exported = np.load(path)
+        models, digests, dims, data = exported["models"], exported["digests"], exported["dims"], exported["data"]
+        ends = np.cumsum(dims)
+        added = 0
+        with self._lock:
+            for model in sorted(set(models.tolist())):
+                rows = [i for i in range(len(models)) if models[i] == model]
+                added += self._append(
+                    model,
+                    [str(digests[i]) for i in rows],
+                    [data[ends[i] - dims[i]:ends[i]] for i in rows],
+                )
+        print(f"Imported {added} of {len(models)} vectors from '{path}'.")
+        return added
+
+    def _append(self, model: str, digests: List[str], vectors) -> int:
+        lines = []
+        with open(self.vectors_path, "ab") as f:
+            offset = f.seek(0, os.SEEK_END)
+            for digest, vector in zip(digests, vectors):
+                if (model, digest) in self._index:
+                    continue
+                row = np.asarray(vector, dtype=np.float32)
+                f.write(row.tobytes())
+                self._index[(model, digest)] = (offset, len(row))
+                lines.append(f"{model}\t{digest}\t{offset}\t{len(row)}\n")
+                offset += row.nbytes
+        if lines:
+            new_index = not os.path.exists(self.index_path)
+            with open(self.index_path, "a", encoding="utf-8") as f:
+                if new_index:
+                    f.write(_index_header(self._generation))
+                f.writelines(lines)
+        return len(lines)
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, "r", encoding="utf-8") as f:
+            self._generation = int(re.fullmatch(r"# vectors-(\d+)\.f32", f.readline().strip()).group(1))
+            size = os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0
+            torn = False
+            for line in f:
+                parts = line.rstrip("\n").split("\t")
+                if not line.endswith("\n") or len(parts) != 4:
+                    torn = not line.endswith("\n")  # a write interrupted at the end of the index
+                    continue
+                model, digest, offset, dim = parts[0], parts[1], int(parts[2]), int(parts[3])
+                if offset + dim * 4 <= size:
+                    self._index[(model, digest)] = (offset, dim)
+        if torn:
+            # Terminate the torn line so the next appended entry starts on a line of its own.
+            with open(self.index_path, "a", encoding="utf-8") as f:
+                f.write("\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect, compact, export or import the ingest embedding store.")
+    parser.add_argument("--dir", default=os.getenv("EMBEDDING_STORE_DIR") or default_store_dir())
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument("--compact", action="store_true")
+    action.add_argument("--export", metavar="FILE")
+    action.add_argument("--import", dest="import_path", metavar="FILE")
+    parser.add_argument("--model", action="append", help="With --compact, keep only these models.")
+    args = parser.parse_args()
+
+    store = EmbeddingStore(args.dir)
+    if args.compact:
+        store.compact(args.model)
+    elif args.export:
+        store.export(args.export)
+    elif args.import_path:
+        store.import_file(args.import_path)
+    else:
+        print(f"Embedding store '{args.dir}': {len(store)} vectors ({', '.join(store.models()) or 'empty'}).")
@@ -0,0 +1,158 @@
+# ingest_pipeline.py
+#
+# Streaming pieces of the ingest: an incremental reader for extracted-content files, a checkpoint
+# of the last committed batch, and a three-stage read -> embed -> upsert pipeline whose stages run
+# concurrently, connected by bounded queues. At most `queue_size` batches wait between two stages,
+# so memory stays flat however large the corpus is.
+
+import asyncio
+import json
+import os
+import time
+
+
+def iter_chunks(path, block_size=1 << 16):
+    """Yields chunks one at a time from a JSON array file or a JSONL file, without loading it whole."""
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.lower().endswith(".jsonl"):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        decoder = json.JSONDecoder()
+        buffer, pos, started = "", 0, False
+        while True:
+            block = f.read(block_size)
+            buffer = buffer[pos:] + block
+            pos = 0
+            while True:
+                while pos < len(buffer) and (buffer[pos].isspace() or (started and buffer[pos] == ",")):
+                    pos += 1
+                if pos >= len(buffer):
+                    break
+                if not started:
+                    if buffer[pos] != "[":
+                        raise ValueError(f"'{path}' is not a JSON array of chunks.")
+                    started, pos = True, pos + 1
+                    continue
+                if buffer[pos] == "]":
+                    return
+                try:
+                    chunk, pos = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    break  # the element continues in the next block
+                yield chunk
+            if not block:
+                raise ValueError(f"'{path}' ended before the closing ']'.")
+
+
+def iter_batches(items, batch_size):
+    """Numbers and groups an iterable into lists of `batch_size`."""
+    batch, batch_no = [], 0
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch_no, batch
+            batch, batch_no = [], batch_no + 1
+    if batch:
+        yield batch_no, batch
+
+
+class IngestCheckpoint:
+    """
+    Records the last batch whose points were committed to Qdrant, and the collection they went to
+    (`target`, which differs from `collection_name` for versioned builds). A checkpoint is only
+    honoured for the same source file (path, size and modification time), collection and batch size.
+    """
+
+    def __init__(self, path, source_path, collection_name, batch_size):
+        self.path = path
+        self.target = None
+        stat = os.stat(source_path)
+        self.key = {
+            "source": os.path.abspath(source_path),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "collection": collection_name,
+            "batch_size": batch_size,
+        }
+
+    def last_committed(self):
+        """Index of the last committed batch, or -1 when there is nothing to resume."""
+        if not os.path.exists(self.path):
+            return -1
+        with open(self.path, 'r', encoding='utf-8') as f:
+            saved = json.load(f)
+        if saved.get("key") != self.key:
+            print(f"Ignoring checkpoint '{self.path}': it belongs to a different source file or collection.")
+            return -1
+        self.target = saved.get("target")
+        return saved["last_committed_batch"]
+
+    def save(self, batch_no):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"key": self.key, "target": self.target, "last_committed_batch": batch_no, "saved_at": time.time()}, f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+_DONE = object()
+
+
+async def run_pipeline(batches, embed_batch, upsert_batch, checkpoint=None, queue_size=2, start_after=-1):
+    """
+    Streams (batch_no, items) from the `batches` iterator through `embed_batch` (async, items -> points)
+    and `upsert_batch` (sync, called in a worker thread). Batches up to `start_after` are skipped.
+    Batches are committed in order and the checkpoint is saved after each one, so a crash loses at
+    most the batches still in flight. Returns the number of points upserted.
+    """
+    to_embed = asyncio.Queue(maxsize=queue_size)
+    to_upsert = asyncio.Queue(maxsize=queue_size)
+    upserted = 0
+
+    async def read():
+        iterator = iter(batches)
+        while True:
+            # Reading and parsing happen off the event loop so embedding keeps going meanwhile.
+            item = await asyncio.to_thread(next, iterator, _DONE)
+            if item is _DONE:
+                break
+            if item[0] > start_after:
+                await to_embed.put(item)
+        await to_embed.put(_DONE)
+
+    async def embed():
+        while True:
+            item = await to_embed.get()
+            if item is _DONE:
+                break
+            batch_no, items = item
+            await to_upsert.put((batch_no, await embed_batch(items)))
+        await to_upsert.put(_DONE)
+
+    async def upsert():
+        nonlocal upserted
+        while True:
+            item = await to_upsert.get()
+            if item is _DONE:
+                break
+            batch_no, points = item
+            if points:
+                await asyncio.to_thread(upsert_batch, points)
+                upserted += len(points)
+            if checkpoint is not None:
+                checkpoint.save(batch_no)
+
+    tasks = [asyncio.create_task(stage()) for stage in (read, embed, upsert)]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    return upserted
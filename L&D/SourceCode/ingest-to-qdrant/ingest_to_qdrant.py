@@ -1,13 +1,32 @@
 # ingest_to_qdrant.py
 
-import json
+import asyncio
 import os
-import time
+import sys
 from qdrant_client import QdrantClient, models
-from openai import AzureOpenAI
+from openai import AsyncAzureOpenAI
 from dotenv import load_dotenv
 from tqdm import tqdm
 
+# The BM25 index format, collection profiles, point ids, token counting and the Azure retry policy are
+# owned by the backend; reuse them so that what ingest builds always matches what the backend expects
+# at query time.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+# Dependency-free helpers shared with the doc-chunker (the Azure rate limiter).
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from bm25_index import build_bm25_index, default_index_path
+from collection_profiles import collection_config, create_payload_indexes
+from point_ids import IDENTITY_FIELDS, chunk_identity, with_point_ids
+
+from batch_embedder import RateLimiter, embed_texts
+from chunk_dedupe import DedupePlan, build_dedupe_plan
+from collection_versions import (
+    discard_unpublished, load_smoke_queries, prune_versions, publish_bm25_index, resolve_collection, smoke_test,
+    switch_alias, versioned_name,
+)
+from embedding_store import EmbeddingStore, default_store_dir
+from ingest_pipeline import IngestCheckpoint, iter_batches, iter_chunks, run_pipeline
+
 # --- Configuration ---
 # Load environment variables from the .env file
 load_dotenv()
@@ -16,6 +35,15 @@ load_dotenv()
 QDRANT_HOST = "localhost"
 QDRANT_PORT = 6333
 COLLECTION_NAME = "Connect_Investigation_Training_Manual_v25.0" # Using a new name to avoid conflicts
+# "versioned" builds a new COLLECTION_NAME__<timestamp> collection, copying the vectors of unchanged
+# chunks from the live version, smoke-tests it and switches the COLLECTION_NAME alias to it;
+# "recreate" does the same but re-embeds every chunk, bypassing the live version and the embedding store; "incremental" embeds and upserts only new or
+# edited chunks into the live collection and deletes vanished ones.
+INGEST_MODE = os.getenv("INGEST_MODE", "versioned").lower()
+# Versions kept after a publish, the live one included, so the previous ones can be rolled back to.
+COLLECTION_VERSIONS_TO_KEEP = int(os.getenv("COLLECTION_VERSIONS_TO_KEEP", "2"))
+# HNSW, quantization and on-disk settings for the collection; see backend/collection_profiles.py
+COLLECTION_PROFILE = os.getenv("COLLECTION_PROFILE", "balanced")
 
 # Azure OpenAI configuration
 AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
@@ -27,13 +55,47 @@ AZURE_API_VERSION = "2023-05-15" # A common, stable API version
 # The 'text-embedding-3-large' model has a fixed dimension of 3072.
 EMBEDDING_SIZE = 3072
 
-# Path to your extracted data
-JSON_FILE_PATH = "C:/connect/L-D/doc-chunker/extracted_content_2.json"
+# Vectors of every chunk ever embedded, keyed by the embedding deployment that produced them and the
+# chunk text, so identical sections in a new manual revision are not embedded again, and a different
+# deployment never gets another model's vectors; see embedding_store.py. Empty disables it.
+EMBEDDING_STORE_DIR = os.getenv("EMBEDDING_STORE_DIR", default_store_dir())
+
+# Embedding throughput: chunks are packed into batches of at most EMBED_BATCH_TOKENS tokens and
+# EMBED_BATCH_INPUTS inputs, EMBED_CONCURRENCY batches are in flight at once, and the client keeps
+# under the deployment's quota (set these to the RPM/TPM assigned to the embedding deployment).
+EMBED_BATCH_TOKENS = int(os.getenv("EMBED_BATCH_TOKENS", "32000"))
+EMBED_BATCH_INPUTS = int(os.getenv("EMBED_BATCH_INPUTS", "256"))
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+EMBED_REQUESTS_PER_MINUTE = float(os.getenv("EMBED_REQUESTS_PER_MINUTE", "2100"))
+EMBED_TOKENS_PER_MINUTE = float(os.getenv("EMBED_TOKENS_PER_MINUTE", "350000"))
+EMBED_MAX_ATTEMPTS = int(os.getenv("EMBED_MAX_ATTEMPTS", "6"))
+
+# Streaming: chunks are read, embedded and upserted UPSERT_BATCH_SIZE at a time, with at most
+# INGEST_QUEUE_SIZE batches waiting between stages. The last committed batch is checkpointed so an
+# interrupted run resumes where it stopped.
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", "256"))
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "2"))
+
+# Near-duplicate chunks (repeated screenshots, boilerplate) are folded into one canonical chunk that
+# lists every section and page it appears on; see chunk_dedupe.py.
+INGEST_DEDUPE = os.getenv("INGEST_DEDUPE", "true").lower() == "true"
+DEDUPE_THRESHOLD = float(os.getenv("DEDUPE_THRESHOLD", "0.85"))
+
+# Path to your extracted data (a JSON array or JSONL file)
+JSON_FILE_PATH = os.getenv("INGEST_SOURCE_PATH", "C:/connect/L-D/doc-chunker/extracted_content_2.json")
+INGEST_CHECKPOINT_PATH = os.getenv("INGEST_CHECKPOINT_PATH", os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), f".ingest_checkpoint_{COLLECTION_NAME}.json"
+))
+
+# Questions a new version must answer from the expected sections before it is published (optional)
+SMOKE_QUERIES_PATH = os.getenv("SMOKE_QUERIES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "smoke_queries.json"))
 
 def ingest_data_with_azure():
     """
-    Reads data from the JSON file, generates embeddings using Azure OpenAI,
-    and ingests it into a Qdrant collection.
+    Reads data from the JSON file, generates embeddings using Azure OpenAI for chunks
+    the live collection does not already hold, and publishes a new collection version
+    (or syncs the live collection in incremental mode). Returns the diff against the
+    previous contents.
     """
     
     # --- Step 1: Validate Azure Configuration ---
@@ -48,79 +110,295 @@ def ingest_data_with_azure():
 
     # --- Step 2: Initialize Azure OpenAI Client ---
     print("\nStep 2: Initializing Azure OpenAI client...")
-    azure_client = AzureOpenAI(
+    azure_client = AsyncAzureOpenAI(
         api_key=AZURE_OPENAI_API_KEY,
         azure_endpoint=AZURE_OPENAI_ENDPOINT,
         api_version=AZURE_API_VERSION,
+        max_retries=0,  # batches are retried by embed_texts
     )
     print("Azure OpenAI client initialized.")
 
-    # --- Step 3: Initialize Qdrant Client and Create Collection ---
-    print("\nStep 3: Initializing Qdrant client and setting up collection...")
-    qdrant_client = QdrantClient(host=QDRANT_HOST, port=QDRANT_PORT)
-    
-    qdrant_client.recreate_collection(
-        collection_name=COLLECTION_NAME,
-        vectors_config=models.VectorParams(
-            size=EMBEDDING_SIZE,
-            distance=models.Distance.COSINE
-        )
-    )
-    print(f"Qdrant collection '{COLLECTION_NAME}' created with vector size {EMBEDDING_SIZE}.")
-
-    # --- Step 4: Load and Prepare Data ---
-    print(f"\nStep 4: Loading data from '{JSON_FILE_PATH}'...")
+    # --- Step 3: Scan the source file ---
+    # Only ids and identities are kept in memory; the chunks themselves are streamed in Step 5.
+    print(f"\nStep 3: Scanning '{JSON_FILE_PATH}'...")
     if not os.path.exists(JSON_FILE_PATH):
         print(f"Error: JSON file not found at '{JSON_FILE_PATH}'")
         return
-        
-    with open(JSON_FILE_PATH, 'r', encoding='utf-8') as f:
-        chunks = json.load(f)
-    
-    # Filter for chunks that have text content to embed
-    text_chunks = [chunk for chunk in chunks if 'content' in chunk and chunk.get('content')]
-    print(f"Loaded {len(chunks)} chunks, found {len(text_chunks)} with content to embed.")
 
-    # --- Step 5: Generate Embeddings and Upload to Qdrant ---
-    print(f"\nStep 5: Generating embeddings via Azure and uploading to Qdrant...")
-    points_to_upload = []
-    
-    # Process chunks one by one to respect API rate limits and show progress
-    for idx, chunk in enumerate(tqdm(text_chunks, desc="Embedding Chunks")):
-        try:
-            # Get the embedding from Azure OpenAI
-            response = azure_client.embeddings.create(
-                input=chunk['content'],
-                model=AZURE_OPENAI_DEPLOYMENT_NAME
-            )
-            embedding_vector = response.data[0].embedding
+    if INGEST_DEDUPE:
+        dedupe_plan = build_dedupe_plan(with_point_ids(_iter_text_chunks()), DEDUPE_THRESHOLD)
+        print(f"Dedupe: {dedupe_plan.summary()}.")
+    else:
+        dedupe_plan = DedupePlan()
+    source_identities = {point_id: chunk_identity(chunk) for point_id, chunk in _iter_source_points(dedupe_plan)}
+    print(f"Found {len(source_identities)} chunks with content to embed.")
 
-            # Create the Qdrant point
-            point = models.PointStruct(
-                id=idx,
-                vector=embedding_vector,
-                payload=chunk
-            )
-            points_to_upload.append(point)
+    # --- Step 4: Compare with the live collection ---
+    print(f"\nStep 4: Comparing with the live collection ({INGEST_MODE} mode)...")
+    qdrant_client = QdrantClient(host=QDRANT_HOST, port=QDRANT_PORT)
+    live_collection = resolve_collection(qdrant_client, COLLECTION_NAME)
+    live_points = _existing_point_identities(qdrant_client, live_collection) if live_collection else {}
+    diff = diff_points(source_identities, live_points)
+    _print_diff(diff)
 
-        except Exception as e:
-            print(f"\nError processing chunk {idx}: {e}")
-            print("Skipping this chunk.")
-            # Optional: Add a small delay and retry logic here if needed
-            time.sleep(1)
-    
-    # Upsert all collected points in a single batch
-    if points_to_upload:
-        print(f"\nUploading {len(points_to_upload)} points to Qdrant...")
-        qdrant_client.upsert(
-            collection_name=COLLECTION_NAME,
-            points=points_to_upload,
+    checkpoint = IngestCheckpoint(INGEST_CHECKPOINT_PATH, JSON_FILE_PATH, COLLECTION_NAME, UPSERT_BATCH_SIZE)
+    start_after = checkpoint.last_committed()
+    if INGEST_MODE == "incremental":
+        target = live_collection or COLLECTION_NAME
+    elif start_after >= 0 and checkpoint.target not in (None, live_collection):
+        target = checkpoint.target  # finish the interrupted build
+    else:
+        discard_unpublished(qdrant_client, COLLECTION_NAME)
+        target = versioned_name(COLLECTION_NAME)
+    if start_after >= 0 and checkpoint.target == target and qdrant_client.collection_exists(target):
+        print(f"Resuming '{target}' after batch {start_after} from checkpoint '{INGEST_CHECKPOINT_PATH}'.")
+    else:
+        start_after = -1
+    checkpoint.target = target
+
+    if not qdrant_client.collection_exists(target):
+        qdrant_client.create_collection(
+            collection_name=target,
+            **collection_config(COLLECTION_PROFILE, EMBEDDING_SIZE)
+        )
+        create_payload_indexes(qdrant_client, target)
+        print(f"Qdrant collection '{target}' created with vector size {EMBEDDING_SIZE} (profile '{COLLECTION_PROFILE}').")
+
+    if INGEST_MODE == "incremental":
+        to_write = set(diff["added"]) | {new_id for _old_id, new_id in diff["changed"]}
+        reusable = set()
+    else:
+        # A versioned build writes every chunk; vectors of chunks the live version already holds are
+        # copied from it ("versioned") or re-embedded ("recreate").
+        in_target = set(_existing_point_identities(qdrant_client, target)) if start_after >= 0 else set()
+        to_write = set(source_identities) - in_target
+        reusable = to_write & set(live_points) if INGEST_MODE == "versioned" else set()
+
+    # --- Step 5: Stream chunks through embedding into Qdrant ---
+    print(f"\nStep 5: Writing {len(to_write)} chunks to '{target}' in batches of {UPSERT_BATCH_SIZE}, "
+          f"embedding {len(to_write) - len(reusable)} "
+          f"({EMBED_CONCURRENCY} concurrent embedding requests, {EMBED_REQUESTS_PER_MINUTE:g} RPM / {EMBED_TOKENS_PER_MINUTE:g} TPM)...")
+    smoke_queries = load_smoke_queries(SMOKE_QUERIES_PATH) if INGEST_MODE != "incremental" else []
+    with tqdm(total=len(to_write), desc="Embedding Chunks") as progress:
+        uploaded, smoke_vectors = asyncio.run(_build_collection(
+            azure_client, qdrant_client, target, dedupe_plan, to_write, reusable, live_collection,
+            checkpoint, start_after, progress, [q["question"] for q in smoke_queries]
+        ))
+
+    # --- Step 6: Delete points that are no longer in the source ---
+    # Deletes go last so the live collection never lacks a section that is being replaced.
+    stale_ids = diff["removed"] + [old_id for old_id, _new_id in diff["changed"]]
+    if INGEST_MODE == "incremental" and stale_ids:
+        print(f"\nStep 6: Deleting {len(stale_ids)} stale points...")
+        qdrant_client.delete(
+            collection_name=target,
+            points_selector=models.PointIdsList(points=stale_ids),
             wait=True
         )
+    else:
+        print("\nStep 6: No stale points to delete.")
+    if INGEST_MODE == "incremental":
+        # A duplicate copy added or removed elsewhere changes a canonical chunk's occurrences but not
+        # its content hash, so the point itself was not rewritten above.
+        updated = _sync_occurrences(qdrant_client, target, dedupe_plan, skip_ids=to_write)
+        if updated:
+            print(f"Updated the occurrences of {updated} unchanged points.")
+
+    # --- Step 7: Build the BM25 lexical index over the current points ---
+    # Every version has its own index file, copied over the alias's one when the alias points to it. An
+    # incremental sync rewrites the live version's file too, so a later rollback or re-publish to it
+    # restores an index that matches its points.
+    bm25_index_path = default_index_path(target)
+    if to_write or stale_ids or not os.path.exists(bm25_index_path):
+        print(f"\nStep 7: Building BM25 index at '{bm25_index_path}'...")
+        # Image captions are searched only by vector (see TypedRetriever), so they stay out of the lexical index.
+        build_bm25_index(
+            ((point_id, chunk) for point_id, chunk in _iter_source_points(dedupe_plan) if chunk.get('type') != 'image'),
+            bm25_index_path,
+        )
+    else:
+        print("\nStep 7: No changes; BM25 index is up to date.")
+    if INGEST_MODE == "incremental":
+        publish_bm25_index(COLLECTION_NAME, target)
+    checkpoint.clear()
+
+    # --- Step 8: Smoke-test the new version and switch the alias to it ---
+    if INGEST_MODE != "incremental":
+        print(f"\nStep 8: Smoke-testing '{target}' ({len(smoke_queries)} smoke queries)...")
+        failures = smoke_test(qdrant_client, target, len(source_identities), smoke_vectors, smoke_queries)
+        if failures:
+            for failure in failures:
+                print(f"WARN: {failure}")
+            raise RuntimeError(
+                f"Smoke test failed for '{target}'; '{COLLECTION_NAME}' still serves '{live_collection}'. "
+                f"The next ingest discards it; to publish it anyway: python collection_versions.py --collection {COLLECTION_NAME} --switch {target}"
+            )
+        switch_alias(qdrant_client, COLLECTION_NAME, target)
+        prune_versions(qdrant_client, COLLECTION_NAME, COLLECTION_VERSIONS_TO_KEEP)
 
     print("\n--- Ingestion Complete! ---")
-    print(f"Successfully uploaded {len(points_to_upload)} data points to the '{COLLECTION_NAME}' collection.")
+    print(f"Successfully uploaded {uploaded} data points to the '{target}' collection.")
     print("You can now verify the data in the Qdrant Dashboard: http://localhost:5173/")
+    return diff
+
+
+def _iter_text_chunks():
+    return (chunk for chunk in iter_chunks(JSON_FILE_PATH) if chunk.get('content'))
+
+
+def _iter_source_points(dedupe_plan):
+    """(point id, chunk) pairs to store: canonical chunks only, with their occurrences."""
+    return dedupe_plan.apply(with_point_ids(_iter_text_chunks(), warn=False))
+
+
+async def _build_collection(azure_client, qdrant_client, target, dedupe_plan, to_write, reusable, live_collection,
+                            checkpoint, start_after, progress, smoke_questions):
+    """
+    Runs the read -> embed -> upsert pipeline over the source file into `target`, then embeds the smoke
+    questions on the same client. A chunk's vector comes from the live collection, then the embedding
+    store, and only then from Azure. Returns the points upserted and the smoke question vectors.
+    """
+    limiter = RateLimiter(EMBED_REQUESTS_PER_MINUTE, EMBED_TOKENS_PER_MINUTE)
+    embedding_store = EmbeddingStore(EMBEDDING_STORE_DIR) if EMBEDDING_STORE_DIR else None
+
+    async def embed(texts):
+        return await embed_texts(
+            azure_client,
+            AZURE_OPENAI_DEPLOYMENT_NAME,
+            texts,
+            max_batch_tokens=EMBED_BATCH_TOKENS,
+            max_batch_inputs=EMBED_BATCH_INPUTS,
+            concurrency=EMBED_CONCURRENCY,
+            max_attempts=EMBED_MAX_ATTEMPTS,
+            limiter=limiter,
+        ) if texts else []
+
+    async def embed_batch(items):
+        needed = [(point_id, chunk) for point_id, chunk in items if point_id in to_write]
+        vectors = {}
+        copy_ids = [point_id for point_id, _chunk in needed if point_id in reusable]
+        if copy_ids:
+            stored = await asyncio.to_thread(
+                qdrant_client.retrieve, collection_name=live_collection, ids=copy_ids, with_vectors=True
+            )
+            vectors.update((str(point.id), point.vector) for point in stored)
+        fresh = [(point_id, chunk) for point_id, chunk in needed if point_id not in vectors]
+        if embedding_store is not None and INGEST_MODE != "recreate":
+            stored = embedding_store.get_many(
+                AZURE_OPENAI_DEPLOYMENT_NAME, [chunk['content'] for _point_id, chunk in fresh], dimension=EMBEDDING_SIZE
+            )
+            vectors.update((point_id, vector) for (point_id, _chunk), vector in zip(fresh, stored) if vector is not None)
+            fresh = [(point_id, chunk) for point_id, chunk in fresh if point_id not in vectors]
+        texts = [chunk['content'] for _point_id, chunk in fresh]
+        embedded = await embed(texts)
+        if embedding_store is not None:
+            embedding_store.put_many(AZURE_OPENAI_DEPLOYMENT_NAME, texts, embedded)
+        vectors.update(zip([point_id for point_id, _chunk in fresh], embedded))
+        progress.update(len(needed))
+        return [
+            models.PointStruct(id=point_id, vector=vectors[point_id], payload=chunk)
+            for point_id, chunk in needed
+        ]
+
+    def upsert_batch(points):
+        qdrant_client.upsert(collection_name=target, points=points, wait=True)
+
+    uploaded = await run_pipeline(
+        iter_batches(_iter_source_points(dedupe_plan), UPSERT_BATCH_SIZE),
+        embed_batch,
+        upsert_batch,
+        checkpoint=checkpoint,
+        queue_size=INGEST_QUEUE_SIZE,
+        start_after=start_after,
+    )
+    return uploaded, await embed(smoke_questions)
+
+
+def _existing_point_identities(qdrant_client, collection_name):
+    """Point id -> (document, section_number, type) for every point already in the collection."""
+    existing, offset = {}, None
+    while True:
+        points, offset = qdrant_client.scroll(
+            collection_name=collection_name,
+            limit=1024,
+            offset=offset,
+            with_payload=models.PayloadSelectorInclude(include=list(IDENTITY_FIELDS)),
+            with_vectors=False,
+        )
+        for point in points:
+            existing[str(point.id)] = chunk_identity(point.payload or {})
+        if offset is None:
+            return existing
+
+
+def _sync_occurrences(qdrant_client, collection_name, dedupe_plan, skip_ids):
+    """Rewrites the `occurrences` payload of points whose stored list differs from the dedupe plan."""
+    stale, offset = {}, None
+    while True:
+        points, offset = qdrant_client.scroll(
+            collection_name=collection_name,
+            limit=1024,
+            offset=offset,
+            with_payload=models.PayloadSelectorInclude(include=["occurrences"]),
+            with_vectors=False,
+        )
+        for point in points:
+            point_id = str(point.id)
+            if point_id in skip_ids:
+                continue
+            refs = dedupe_plan.occurrences.get(point_id, ())
+            expected = refs if len(refs) > 1 else None
+            if (point.payload or {}).get("occurrences") != expected:
+                stale[point_id] = expected
+        if offset is None:
+            break
+
+    cleared = [point_id for point_id, expected in stale.items() if expected is None]
+    if cleared:
+        qdrant_client.delete_payload(
+            collection_name=collection_name, keys=["occurrences"], points=cleared, wait=True
+        )
+    for point_id, expected in stale.items():
+        if expected is not None:
+            qdrant_client.set_payload(
+                collection_name=collection_name, payload={"occurrences": expected}, points=[point_id], wait=True
+            )
+    return len(stale)
+
+
+def diff_points(source_identities, existing_points):
+    """
+    Splits the source point ids (id -> identity, in file order) against the existing ones. A removed
+    point and an added point at the same document/section/type are reported as one changed chunk.
+    """
+    added = [point_id for point_id in source_identities if point_id not in existing_points]
+    removed = [point_id for point_id in existing_points if point_id not in source_identities]
+
+    removed_by_identity = {}
+    for point_id in removed:
+        removed_by_identity.setdefault(existing_points[point_id], []).append(point_id)
+    changed, still_added = [], []
+    for point_id in added:
+        candidates = removed_by_identity.get(source_identities[point_id])
+        if candidates:
+            changed.append((candidates.pop(0), point_id))
+        else:
+            still_added.append(point_id)
+    paired = {old_id for old_id, _new_id in changed}
+    return {
+        "added": still_added,
+        "changed": changed,
+        "removed": [point_id for point_id in removed if point_id not in paired],
+        "unchanged": len(source_identities) - len(added),
+        "changed_sections": sorted({source_identities[new_id][1] for _old_id, new_id in changed}),
+    }
+
+
+def _print_diff(diff):
+    print(f"  unchanged: {diff['unchanged']}")
+    print(f"  added:     {len(diff['added'])}")
+    print(f"  changed:   {len(diff['changed'])}" + (f" (sections {', '.join(diff['changed_sections'])})" if diff['changed'] else ""))
+    print(f"  removed:   {len(diff['removed'])}")
 
 
 if __name__ == '__main__':